@@ -36,6 +36,7 @@ ApiStack(
     app,
     "Api",
     table=persistence.table,
+    version_table=persistence.version_table,
     project_config=project_config,
     env=cdk.Environment(
         account=app.account,
@@ -49,6 +50,7 @@ LineWebhookStack(
     bucket=persistence.bucket,
     original_image_created_topic=persistence.original_image_created_topic,
     table=persistence.table,
+    version_table=persistence.version_table,
     project_config=project_config,
     env=cdk.Environment(
         account=app.account,
@@ -60,6 +62,8 @@ HostingImageStack(
     app,
     "HostingImage",
     bucket=persistence.bucket,
+    table=persistence.table,
+    version_table=persistence.version_table,
     project_config=project_config,
     env=cdk.Environment(
         account=app.account,
@@ -19,11 +19,19 @@ class ApiStack(cdk.Stack):
         scope: cdk.Construct,
         construct_id: str,
         table: dynamodb.Table,
+        version_table: dynamodb.Table,
         project_config: ProjectConfig,
         **kwargs,
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        layer = lambda_python.PythonLayerVersion(
+            self,
+            "Layer",
+            entry="src/layers/api_package",
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
+        )
+
         authorizer_function = lambda_python.PythonFunction(
             self,
             "AuthorizerFunction",
@@ -31,10 +39,12 @@ class ApiStack(cdk.Stack):
             index="index.py",
             handler="lambda_handler",
             runtime=lambda_.Runtime.PYTHON_3_8,
+            layers=[layer],
             timeout=cdk.Duration.seconds(3),
             environment={
                 "LOG_LEVEL": project_config.log_level,
                 "POWERTOOLS_SERVICE_NAME": project_config.service_name,
+                "POWERTOOLS_METRICS_NAMESPACE": project_config.service_name,
                 "LINE_LOGIN_CHANNEL_ID": project_config.line_login_channel_id,
                 "SENTRY_DSN": project_config.sentry_dsn,
             },
@@ -46,13 +56,6 @@ class ApiStack(cdk.Stack):
             handler=authorizer_function,
         )
 
-        layer = lambda_python.PythonLayerVersion(
-            self,
-            "Layer",
-            entry="src/layers/api_package",
-            compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
-        )
-
         get_images_function = lambda_python.PythonFunction(
             self,
             "GetImagesFunction",
@@ -67,9 +70,12 @@ class ApiStack(cdk.Stack):
                 "POWERTOOLS_SERVICE_NAME": project_config.service_name,
                 "TABLE_NAME": table.table_name,
                 "TABLE_REGION": self.region,
+                "VERSION_TABLE_NAME": version_table.table_name,
                 "IMAGE_BASE_URL": "https://"
                 + project_config.hosting_image_domain,
                 "IMAGE_PREFIX": project_config.hosting_image_prefix,
+                "CURSOR_SECRET": project_config.api_cursor_secret,
+                "IMAGE_URL_SECRET": project_config.image_url_secret,
                 "SENTRY_DSN": project_config.sentry_dsn,
             },
             initial_policy=[
@@ -82,7 +88,14 @@ class ApiStack(cdk.Stack):
                         "dynamodb:Query",
                         "dynamodb:Scan",
                     ],
-                    resources=[table.table_arn],
+                    resources=[
+                        table.table_arn,
+                        table.table_arn + "/index/*",
+                    ],
+                ),
+                iam.PolicyStatement(
+                    actions=["dynamodb:GetItem"],
+                    resources=[version_table.table_arn],
                 ),
             ],
             log_retention=logs.RetentionDays.ONE_MONTH,
@@ -94,6 +107,8 @@ class ApiStack(cdk.Stack):
             default_cors_preflight_options=apigateway.CorsOptions(
                 allow_origins=apigateway.Cors.ALL_ORIGINS,
                 allow_methods=apigateway.Cors.ALL_METHODS,
+                allow_headers=apigateway.Cors.DEFAULT_HEADERS
+                + ["If-None-Match"],
             ),
         )
         api.add_gateway_response(
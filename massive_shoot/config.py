@@ -1,3 +1,5 @@
+import hashlib
+import hmac
 import os
 
 
@@ -10,8 +12,28 @@ class ProjectConfig:
         self.line_login_channel_id = os.environ["LINE_LOGIN_CHANNEL_ID"]
         self.hosting_image_domain = os.environ["HOSTING_IMAGE_DOMAIN"]
         self.hosting_image_acm_arn = os.environ["HOSTING_IMAGE_ACM_ARN"]
+        self.api_cursor_secret = os.environ["API_CURSOR_SECRET"]
+        self.image_url_secret = os.environ["IMAGE_URL_SECRET"]
+        # acknowledge webhooks once the raw body is queued and dispatch the
+        # events from the queue instead of inside the request
+        self.line_webhook_fast_ack = os.environ.get(
+            "LINE_WEBHOOK_FAST_ACK", "false"
+        ).lower() in ("1", "true", "yes")
         self.sentry_dsn = os.environ.get("SENTRY_DSN", "")
         self.log_level = os.environ.get("LOG_LEVEL", "INFO")
 
         self.save_image_prefix = ".images"
         self.hosting_image_prefix = "images"
+        self.image_widths = [
+            int(width)
+            for width in os.environ.get(
+                "IMAGE_WIDTHS", "200,400,800,1600"
+            ).split(",")
+        ]
+        # shared by CloudFront and the variant generator origin, derived so
+        # the URL signing key itself never leaves the edge and the API
+        self.hosting_origin_secret = hmac.new(
+            self.image_url_secret.encode(),
+            b"hosting-origin",
+            hashlib.sha256,
+        ).hexdigest()
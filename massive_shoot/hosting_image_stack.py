@@ -1,8 +1,20 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
 from aws_cdk import (
+    aws_apigateway as apigateway,
     aws_certificatemanager as acm,
     aws_cloudfront as cloudfront,
     aws_cloudfront_origins as origins,
+    aws_dynamodb as dynamodb,
+    aws_iam as iam,
     aws_lambda as lambda_,
+    aws_lambda_python as lambda_python,
+    aws_logs as logs,
     aws_s3 as s3,
     core as cdk,
 )
@@ -17,6 +29,8 @@ class HostingImageStack(cdk.Stack):
         scope: cdk.Construct,
         construct_id: str,
         bucket: s3.Bucket,
+        table: dynamodb.Table,
+        version_table: dynamodb.Table,
         project_config: ProjectConfig,
         **kwargs,
     ) -> None:
@@ -27,7 +41,7 @@ class HostingImageStack(cdk.Stack):
             "EdgeFunction",
             runtime=lambda_.Runtime.PYTHON_3_8,
             handler="index.lambda_handler",
-            code=lambda_.Code.from_asset("src/functions/hosting_image_edge/"),
+            code=self._edge_function_code(project_config),
             timeout=cdk.Duration.seconds(1),
         )
 
@@ -35,8 +49,18 @@ class HostingImageStack(cdk.Stack):
             self,
             "Distribution",
             default_behavior=cloudfront.BehaviorOptions(
-                origin=origins.S3Origin(
-                    bucket=bucket,
+                # variants missing from the bucket are generated on demand
+                origin=origins.OriginGroup(
+                    primary_origin=origins.S3Origin(
+                        bucket=bucket,
+                    ),
+                    fallback_origin=self._variant_origin(
+                        bucket=bucket,
+                        table=table,
+                        version_table=version_table,
+                        project_config=project_config,
+                    ),
+                    fallback_status_codes=[403, 404],
                 ),
                 origin_request_policy=cloudfront.OriginRequestPolicy.CORS_S3_ORIGIN,  # noqa
                 allowed_methods=cloudfront.AllowedMethods.ALLOW_GET_HEAD_OPTIONS,  # noqa
@@ -54,3 +78,124 @@ class HostingImageStack(cdk.Stack):
                 certificate_arn=project_config.hosting_image_acm_arn,
             ),
         )
+
+    def _variant_origin(
+        self,
+        bucket: s3.Bucket,
+        table: dynamodb.Table,
+        version_table: dynamodb.Table,
+        project_config: ProjectConfig,
+    ) -> cloudfront.IOrigin:
+        function = lambda_python.PythonFunction(
+            self,
+            "GenerateVariantFunction",
+            entry="src/functions/hosting_image_generate_variant",
+            index="index.py",
+            handler="lambda_handler",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            memory_size=1024,
+            timeout=cdk.Duration.seconds(25),
+            environment={
+                "LOG_LEVEL": project_config.log_level,
+                "POWERTOOLS_SERVICE_NAME": project_config.service_name,
+                "SAVE_IMAGE_PREFIX": project_config.save_image_prefix,
+                "BUCKET_NAME": bucket.bucket_name,
+                "IMAGE_WIDTHS": ",".join(
+                    str(width) for width in project_config.image_widths
+                ),
+                "ORIGIN_SECRET": project_config.hosting_origin_secret,
+                "TABLE_NAME": table.table_name,
+                "VERSION_TABLE_NAME": version_table.table_name,
+                "SENTRY_DSN": project_config.sentry_dsn,
+            },
+            initial_policy=[
+                iam.PolicyStatement(
+                    actions=[
+                        "s3:GetObject",
+                        "s3:PutObject",
+                    ],
+                    resources=[bucket.bucket_arn + "/*"],
+                ),
+                # without it S3 answers 403 instead of NoSuchKey for a
+                # missing original
+                iam.PolicyStatement(
+                    actions=["s3:ListBucket"],
+                    resources=[bucket.bucket_arn],
+                ),
+                iam.PolicyStatement(
+                    actions=["dynamodb:UpdateItem"],
+                    resources=[
+                        table.table_arn,
+                        version_table.table_arn,
+                    ],
+                ),
+            ],
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+
+        api = apigateway.LambdaRestApi(
+            self,
+            "GenerateVariantApi",
+            handler=function,
+            binary_media_types=["*/*"],
+        )
+
+        return origins.HttpOrigin(
+            f"{api.rest_api_id}.execute-api.{self.region}.amazonaws.com",
+            origin_path=f"/{api.deployment_stage.stage_name}",
+            custom_headers={
+                "X-Origin-Secret": project_config.hosting_origin_secret,
+            },
+        )
+
+    def _edge_function_code(
+        self,
+        project_config: ProjectConfig,
+    ) -> lambda_.Code:
+        # Lambda@Edge does not support environment variables, so the
+        # settings are bundled into the asset as config.json
+        asset_dir = os.path.join(tempfile.mkdtemp(), "hosting_image_edge")
+        shutil.copytree(
+            "src/functions/hosting_image_edge",
+            asset_dir,
+            ignore=shutil.ignore_patterns("__pycache__", "config.json"),
+        )
+        # shared with the API functions through the layer, which Lambda@Edge
+        # cannot use
+        shutil.copy(
+            "src/layers/api_package/utils/ttl_cache.py",
+            os.path.join(asset_dir, "ttl_cache.py"),
+        )
+        # Lambda@Edge cannot use layers either, so the function's pure-Python
+        # requirements are installed next to its code; --no-compile keeps
+        # the asset hash stable between synths
+        subprocess.run(
+            [
+                sys.executable,
+                "-m",
+                "pip",
+                "install",
+                "--quiet",
+                "--no-compile",
+                "--requirement",
+                "src/functions/hosting_image_edge/requirements.txt",
+                "--target",
+                asset_dir,
+            ],
+            check=True,
+        )
+        with open(os.path.join(asset_dir, "config.json"), "w") as fp:
+            json.dump(
+                {
+                    "save_image_prefix": project_config.save_image_prefix,
+                    "hosting_image_prefix": project_config.hosting_image_prefix,  # noqa
+                    "line_login_channel_id": project_config.line_login_channel_id,  # noqa
+                    "image_url_secret": project_config.image_url_secret,
+                    "image_widths": project_config.image_widths,
+                },
+                fp,
+                indent=2,
+                sort_keys=True,
+            )
+
+        return lambda_.Code.from_asset(asset_dir)
@@ -24,6 +24,7 @@ class LineWebhookStack(cdk.Stack):
         bucket: s3.Bucket,
         original_image_created_topic: sns.Topic,
         table: dynamodb.Table,
+        version_table: dynamodb.Table,
         project_config: ProjectConfig,
         **kwargs,
     ) -> None:
@@ -31,33 +32,28 @@ class LineWebhookStack(cdk.Stack):
 
         self._webhook_to_bucket(
             bucket=bucket,
+            topic=original_image_created_topic,
             project_config=project_config,
         )
         self._topic_to_table(
             topic=original_image_created_topic,
             bucket=bucket,
             table=table,
+            version_table=version_table,
             project_config=project_config,
         )
-        self._topic_to_resize_400(
-            topic=original_image_created_topic,
-            bucket=bucket,
-            project_config=project_config,
-        )
-        self._topic_to_webp(
-            topic=original_image_created_topic,
-            bucket=bucket,
-            project_config=project_config,
-        )
-        self._topic_to_webp_resize_400(
+        self._topic_to_derivatives(
             topic=original_image_created_topic,
             bucket=bucket,
+            table=table,
+            version_table=version_table,
             project_config=project_config,
         )
 
     def _webhook_to_bucket(
         self,
         bucket: s3.Bucket,
+        topic: sns.Topic,
         project_config: ProjectConfig,
     ) -> None:
         queue = sqs.Queue(
@@ -65,6 +61,10 @@ class LineWebhookStack(cdk.Stack):
             "SaveImageQueue",
         )
 
+        # records of a batch run concurrently and each buffers up to about
+        # 25 MiB of upload parts
+        record_concurrency = 10
+
         function = lambda_python.PythonFunction(
             self,
             "SaveImageFunction",
@@ -72,13 +72,16 @@ class LineWebhookStack(cdk.Stack):
             index="index.py",
             handler="lambda_handler",
             runtime=lambda_.Runtime.PYTHON_3_8,
+            memory_size=256 + record_concurrency * 32,
             timeout=cdk.Duration.seconds(10),
             environment={
+                "RECORD_CONCURRENCY": str(record_concurrency),
                 "LOG_LEVEL": project_config.log_level,
                 "POWERTOOLS_SERVICE_NAME": project_config.service_name,
                 "CHANNEL_ACCESS_TOKEN": project_config.line_channel_access_token,  # noqa
                 "SAVE_IMAGE_PREFIX": project_config.save_image_prefix,
                 "BUCKET_NAME": bucket.bucket_name,
+                "ORIGINAL_IMAGE_CREATED_TOPIC_ARN": topic.topic_arn,
                 "SENTRY_DSN": project_config.sentry_dsn,
             },
             initial_policy=[
@@ -93,6 +96,10 @@ class LineWebhookStack(cdk.Stack):
                         bucket.bucket_arn + "/*",
                     ],
                 ),
+                iam.PolicyStatement(
+                    actions=["sns:Publish"],
+                    resources=[topic.topic_arn],
+                ),
             ],
             log_retention=logs.RetentionDays.ONE_MONTH,
         )
@@ -102,6 +109,40 @@ class LineWebhookStack(cdk.Stack):
             ),
         )
 
+        # deliveries that keep failing are set aside instead of being
+        # redelivered until they expire
+        webhook_event_dead_letter_queue = sqs.Queue(
+            self,
+            "WebhookEventDeadLetterQueue",
+            retention_period=cdk.Duration.days(14),
+        )
+        webhook_event_queue = sqs.Queue(
+            self,
+            "WebhookEventQueue",
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5,
+                queue=webhook_event_dead_letter_queue,
+            ),
+        )
+
+        # the event handlers shared by the synchronous webhook and the
+        # fast ack dispatcher
+        webhook_layer = lambda_python.PythonLayerVersion(
+            self,
+            "WebhookLayer",
+            entry="src/layers/line_webhook_package",
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_8],
+        )
+
+        line_environment = {
+            "LOG_LEVEL": project_config.log_level,
+            "POWERTOOLS_SERVICE_NAME": project_config.service_name,
+            "CHANNEL_ACCESS_TOKEN": project_config.line_channel_access_token,
+            "CHANNEL_SECRET": project_config.line_channel_secret,
+            "SAVE_IMAGE_QUEUE_URL": queue.queue_url,
+            "SENTRY_DSN": project_config.sentry_dsn,
+        }
+
         post_callback_function = lambda_python.PythonFunction(
             self,
             "PostCallbackFunction",
@@ -109,15 +150,39 @@ class LineWebhookStack(cdk.Stack):
             index="index.py",
             handler="lambda_handler",
             runtime=lambda_.Runtime.PYTHON_3_8,
+            layers=[webhook_layer],
             environment={
-                "LOG_LEVEL": project_config.log_level,
-                "POWERTOOLS_SERVICE_NAME": project_config.service_name,
-                "CHANNEL_ACCESS_TOKEN": project_config.line_channel_access_token,  # noqa
-                "CHANNEL_SECRET": project_config.line_channel_secret,
-                "SAVE_IMAGE_QUEUE_URL": queue.queue_url,
-                "SENTRY_DSN": project_config.sentry_dsn,
+                **line_environment,
+                "FAST_ACK": str(project_config.line_webhook_fast_ack).lower(),
+                "WEBHOOK_EVENT_QUEUE_URL": webhook_event_queue.queue_url,
             },
             initial_policy=[
+                iam.PolicyStatement(
+                    actions=["sqs:SendMessage"],
+                    resources=[
+                        queue.queue_arn,
+                        webhook_event_queue.queue_arn,
+                    ],
+                ),
+            ],
+            log_retention=logs.RetentionDays.ONE_MONTH,
+        )
+
+        dispatch_events_function = lambda_python.PythonFunction(
+            self,
+            "DispatchEventsFunction",
+            entry="src/functions/line_webhook_dispatch_events",
+            index="index.py",
+            handler="lambda_handler",
+            runtime=lambda_.Runtime.PYTHON_3_8,
+            layers=[webhook_layer],
+            timeout=cdk.Duration.seconds(10),
+            environment=line_environment,
+            initial_policy=[
+                iam.PolicyStatement(
+                    actions=["sqs:DeleteMessageBatch"],
+                    resources=[webhook_event_queue.queue_arn],
+                ),
                 iam.PolicyStatement(
                     actions=["sqs:SendMessage"],
                     resources=[queue.queue_arn],
@@ -125,6 +190,11 @@ class LineWebhookStack(cdk.Stack):
             ],
             log_retention=logs.RetentionDays.ONE_MONTH,
         )
+        dispatch_events_function.add_event_source(
+            lambda_event_sources.SqsEventSource(
+                queue=webhook_event_queue,
+            ),
+        )
 
         api = apigateway.RestApi(
             self,
@@ -144,6 +214,7 @@ class LineWebhookStack(cdk.Stack):
         topic: sns.Topic,
         bucket: s3.Bucket,
         table: dynamodb.Table,
+        version_table: dynamodb.Table,
         project_config: ProjectConfig,
     ) -> None:
         queue = sqs.Queue(
@@ -164,6 +235,7 @@ class LineWebhookStack(cdk.Stack):
                 "LOG_LEVEL": project_config.log_level,
                 "POWERTOOLS_SERVICE_NAME": project_config.service_name,
                 "TABLE_NAME": table.table_name,
+                "VERSION_TABLE_NAME": version_table.table_name,
                 "SENTRY_DSN": project_config.sentry_dsn,
             },
             initial_policy=[
@@ -183,53 +255,9 @@ class LineWebhookStack(cdk.Stack):
                 ),
                 iam.PolicyStatement(
                     actions=["dynamodb:*"],
-                    resources=[table.table_arn],
-                ),
-            ],
-            log_retention=logs.RetentionDays.ONE_MONTH,
-        )
-        function.add_event_source(
-            lambda_event_sources.SqsEventSource(
-                queue=queue,
-            ),
-        )
-
-    def _topic_to_resize_400(
-        self,
-        topic: sns.Topic,
-        bucket: s3.Bucket,
-        project_config: ProjectConfig,
-    ) -> None:
-        queue = sqs.Queue(
-            self,
-            "SaveResize400Queue",
-        )
-        topic.add_subscription(subscriptions.SqsSubscription(queue))
-
-        function = lambda_python.PythonFunction(
-            self,
-            "SaveResize400Function",
-            entry="src/functions/line_webhook_save_resize_400",
-            index="index.py",
-            handler="lambda_handler",
-            runtime=lambda_.Runtime.PYTHON_3_8,
-            timeout=cdk.Duration.seconds(10),
-            environment={
-                "LOG_LEVEL": project_config.log_level,
-                "POWERTOOLS_SERVICE_NAME": project_config.service_name,
-                "SAVE_IMAGE_PREFIX": project_config.save_image_prefix,
-                "SENTRY_DSN": project_config.sentry_dsn,
-            },
-            initial_policy=[
-                iam.PolicyStatement(
-                    actions=["sqs:DeleteMessageBatch"],
-                    resources=[queue.queue_arn],
-                ),
-                iam.PolicyStatement(
-                    actions=["s3:*"],
                     resources=[
-                        bucket.bucket_arn,
-                        bucket.bucket_arn + "/*",
+                        table.table_arn,
+                        version_table.table_arn,
                     ],
                 ),
             ],
@@ -241,30 +269,49 @@ class LineWebhookStack(cdk.Stack):
             ),
         )
 
-    def _topic_to_webp(
+    def _topic_to_derivatives(
         self,
         topic: sns.Topic,
         bucket: s3.Bucket,
+        table: dynamodb.Table,
+        version_table: dynamodb.Table,
         project_config: ProjectConfig,
     ) -> None:
+        # originals that keep failing to decode or encode are set aside
+        # instead of being redelivered until they expire
+        dead_letter_queue = sqs.Queue(
+            self,
+            "SaveDerivativesDeadLetterQueue",
+            retention_period=cdk.Duration.days(14),
+        )
         queue = sqs.Queue(
             self,
-            "SaveWebpQueue",
+            "SaveDerivativesQueue",
+            visibility_timeout=cdk.Duration.minutes(5),
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5,
+                queue=dead_letter_queue,
+            ),
         )
         topic.add_subscription(subscriptions.SqsSubscription(queue))
 
         function = lambda_python.PythonFunction(
             self,
-            "SaveWebpFunction",
-            entry="src/functions/line_webhook_save_webp",
+            "SaveDerivativesFunction",
+            entry="src/functions/line_webhook_save_derivatives",
             index="index.py",
             handler="lambda_handler",
             runtime=lambda_.Runtime.PYTHON_3_8,
-            timeout=cdk.Duration.seconds(10),
+            # every variant is encoded here, AVIF being the most CPU heavy;
+            # more memory also means more CPU
+            memory_size=2048,
+            timeout=cdk.Duration.seconds(60),
             environment={
                 "LOG_LEVEL": project_config.log_level,
                 "POWERTOOLS_SERVICE_NAME": project_config.service_name,
                 "SAVE_IMAGE_PREFIX": project_config.save_image_prefix,
+                "TABLE_NAME": table.table_name,
+                "VERSION_TABLE_NAME": version_table.table_name,
                 "SENTRY_DSN": project_config.sentry_dsn,
             },
             initial_policy=[
@@ -279,58 +326,21 @@ class LineWebhookStack(cdk.Stack):
                         bucket.bucket_arn + "/*",
                     ],
                 ),
-            ],
-            log_retention=logs.RetentionDays.ONE_MONTH,
-        )
-        function.add_event_source(
-            lambda_event_sources.SqsEventSource(
-                queue=queue,
-            ),
-        )
-
-    def _topic_to_webp_resize_400(
-        self,
-        topic: sns.Topic,
-        bucket: s3.Bucket,
-        project_config: ProjectConfig,
-    ) -> None:
-        queue = sqs.Queue(
-            self,
-            "SaveWebpResize400Queue",
-        )
-        topic.add_subscription(subscriptions.SqsSubscription(queue))
-
-        function = lambda_python.PythonFunction(
-            self,
-            "SaveWebpResize400Function",
-            entry="src/functions/line_webhook_save_webp_resize_400",
-            index="index.py",
-            handler="lambda_handler",
-            runtime=lambda_.Runtime.PYTHON_3_8,
-            timeout=cdk.Duration.seconds(10),
-            environment={
-                "LOG_LEVEL": project_config.log_level,
-                "POWERTOOLS_SERVICE_NAME": project_config.service_name,
-                "SAVE_IMAGE_PREFIX": project_config.save_image_prefix,
-                "SENTRY_DSN": project_config.sentry_dsn,
-            },
-            initial_policy=[
-                iam.PolicyStatement(
-                    actions=["sqs:DeleteMessageBatch"],
-                    resources=[queue.queue_arn],
-                ),
                 iam.PolicyStatement(
-                    actions=["s3:*"],
+                    actions=["dynamodb:UpdateItem"],
                     resources=[
-                        bucket.bucket_arn,
-                        bucket.bucket_arn + "/*",
+                        table.table_arn,
+                        version_table.table_arn,
                     ],
                 ),
             ],
             log_retention=logs.RetentionDays.ONE_MONTH,
         )
+        # one original per invocation: a large photo takes several seconds
+        # to encode, so a full batch would not fit in the timeout
         function.add_event_source(
             lambda_event_sources.SqsEventSource(
                 queue=queue,
+                batch_size=1,
             ),
         )
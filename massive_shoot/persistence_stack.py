@@ -1,7 +1,6 @@
 from aws_cdk import (
     aws_dynamodb as dynamodb,
     aws_s3 as s3,
-    aws_s3_notifications as notifications,
     aws_sns as sns,
     core as cdk,
 )
@@ -19,6 +18,7 @@ class PersistenceStack(cdk.Stack):
     ) -> None:
         super().__init__(scope, construct_id, **kwargs)
 
+        # published by the save image function with the original's metadata
         self.original_image_created_topic = sns.Topic(
             self,
             "OriginalImageCreatedTopic",
@@ -38,12 +38,6 @@ class PersistenceStack(cdk.Stack):
             ],
             encryption=s3.BucketEncryption.S3_MANAGED,
         )
-        self.bucket.add_object_created_notification(
-            notifications.SnsDestination(self.original_image_created_topic),
-            s3.NotificationKeyFilter(
-                prefix=f"{project_config.save_image_prefix}/original/",
-            ),
-        )
 
         self.table = dynamodb.Table(
             self,
@@ -59,3 +53,26 @@ class PersistenceStack(cdk.Stack):
             ),
             encryption=dynamodb.TableEncryption.AWS_MANAGED,
         )
+        self.table.add_global_secondary_index(
+            index_name="UserIdCreatedIndex",
+            partition_key=dynamodb.Attribute(
+                name="UserId",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            sort_key=dynamodb.Attribute(
+                name="Created",
+                type=dynamodb.AttributeType.NUMBER,
+            ),
+            projection_type=dynamodb.ProjectionType.ALL,
+        )
+
+        self.version_table = dynamodb.Table(
+            self,
+            "VersionTable",
+            table_name=f"{project_config.service_name}-versions",
+            partition_key=dynamodb.Attribute(
+                name="UserId",
+                type=dynamodb.AttributeType.STRING,
+            ),
+            encryption=dynamodb.TableEncryption.AWS_MANAGED,
+        )
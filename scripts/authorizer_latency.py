@@ -0,0 +1,102 @@
+import argparse
+from http.server import (
+    BaseHTTPRequestHandler,
+    ThreadingHTTPServer,
+)
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+import uuid
+
+# measures the authorizer's cache-miss latency against a local stand-in for
+# the LINE API whose responses are delayed by --delay seconds:
+#   python scripts/authorizer_latency.py --delay 0.05 --requests 50
+
+CHANNEL_ID = "1234567890"
+
+
+class LineApiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    delay = 0.0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        if self.path.startswith("/v2/profile"):
+            body = {"userId": "U0", "displayName": "bench"}
+        else:
+            body = {"client_id": CHANNEL_ID, "expires_in": 3600}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+def measure(function, requests: int):
+    timings = []
+    for _ in range(requests):
+        # a fresh token every time, so the token cache never answers
+        token = uuid.uuid4().hex
+        start = time.perf_counter()
+        function(token)
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+
+def report(name: str, timings):
+    timings = sorted(timings)
+    p95 = timings[int(len(timings) * 0.95) - 1]
+    print(
+        f"{name:<12} p50 {statistics.median(timings):7.1f} ms"
+        f"  p95 {p95:7.1f} ms"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--delay", type=float, default=0.05)
+    parser.add_argument("--requests", type=int, default=50)
+    args = parser.parse_args()
+
+    LineApiHandler.delay = args.delay
+    server = ThreadingHTTPServer(("127.0.0.1", 0), LineApiHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    os.environ.update(
+        {
+            "LINE_LOGIN_CHANNEL_ID": CHANNEL_ID,
+            "LINE_API_BASE_URL": f"http://127.0.0.1:{server.server_port}",
+            "LOG_LEVEL": "WARNING",
+            "POWERTOOLS_TRACE_DISABLED": "true",
+        }
+    )
+    root = os.path.join(os.path.dirname(__file__), "..")
+    sys.path[:0] = [
+        os.path.join(root, "src/functions/api_authorizer"),
+        os.path.join(root, "src/layers/api_package"),
+    ]
+    import index
+
+    def sequential(token: str):
+        index.verify_token(token)
+        index.get_profile(token)
+
+    # warm up the pooled connections before timing
+    measure(index.authorize, 2)
+
+    print(f"LINE API delay {args.delay * 1000:.0f} ms")
+    report("sequential", measure(sequential, args.requests))
+    report("concurrent", measure(index.authorize, args.requests))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
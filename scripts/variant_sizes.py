@@ -0,0 +1,75 @@
+import argparse
+import os
+import sys
+
+# encodes every image in a directory the way line_webhook_save_derivatives
+# does and compares the bytes of each variant with the original:
+#   python scripts/variant_sizes.py ~/Pictures/sample
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("directory")
+    args = parser.parse_args()
+
+    os.environ.update(
+        {
+            "SAVE_IMAGE_PREFIX": "bench",
+            "TABLE_NAME": "bench",
+            "VERSION_TABLE_NAME": "bench",
+            "AWS_DEFAULT_REGION": "us-east-1",
+            "LOG_LEVEL": "WARNING",
+            "POWERTOOLS_TRACE_DISABLED": "true",
+        }
+    )
+    sys.path.insert(
+        0,
+        os.path.join(
+            os.path.dirname(__file__),
+            "../src/functions/line_webhook_save_derivatives",
+        ),
+    )
+    import index
+    from PIL import Image
+
+    totals = {}
+    for name in sorted(os.listdir(args.directory)):
+        path = os.path.join(args.directory, name)
+        try:
+            image = Image.open(path)
+        except (IsADirectoryError, Image.UnidentifiedImageError):
+            continue
+        image.load()
+        original_size = os.path.getsize(path)
+        original_format = image.format
+        sizes = {("original_format", "original_size"): original_size}
+        # the same order as the worker: full size first, then thumbnails
+        for directory, size, format in sorted(
+            index.variants, key=lambda variant: variant[1] != "original_size"
+        ):
+            if size != "original_size":
+                image.thumbnail((int(size), int(size)))
+            data = index.encode_image(image, format or original_format)
+            sizes[(directory, size)] = len(data)
+        print(
+            name,
+            " ".join(
+                f"{directory}/{size}={length}"
+                for (directory, size), length in sizes.items()
+            ),
+        )
+        for key, length in sizes.items():
+            totals[key] = totals.get(key, 0) + length
+
+    if not totals:
+        return
+    base = totals[("original_format", "original_size")]
+    for (directory, size), length in totals.items():
+        print(
+            f"{directory + '/' + size:<28} {length:>12,} bytes"
+            f"  {length / base:7.1%} of the originals"
+        )
+
+
+if __name__ == "__main__":
+    main()
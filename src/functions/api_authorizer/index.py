@@ -1,19 +1,55 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import os
+import time
 import typing
 
 from aws_lambda_powertools import (
     Logger,
+    Metrics,
     Tracer,
 )
+from aws_lambda_powertools.metrics import MetricUnit
+import jwt
 import requests
 import sentry_sdk
 from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
 
+from utils.ttl_cache import TTLCache
+
 
 tracer = Tracer()
 logger = Logger()
+metrics = Metrics()
 
 channel_id = os.environ["LINE_LOGIN_CHANNEL_ID"]
+line_api_base_url = os.environ.get("LINE_API_BASE_URL", "https://api.line.me")
+line_api_timeout = (
+    float(os.environ.get("LINE_API_CONNECT_TIMEOUT", "0.5")),
+    float(os.environ.get("LINE_API_READ_TIMEOUT", "1.5")),
+)
+
+line_id_token_issuer = "https://access.line.me"
+
+# kept across warm invocations so LINE connections are reused
+session = requests.Session()
+executor = ThreadPoolExecutor(max_workers=2)
+
+# LINE's ID token signing keys, fetched once and cached by the client;
+# urlopen takes a single timeout for connecting and for each read
+jwks_client = jwt.PyJWKClient(
+    f"{line_api_base_url}/oauth2/v2.1/certs",
+    timeout=max(line_api_timeout),
+)
+
+# verified profiles (or denial messages) keyed by a hash of the token
+token_cache = TTLCache(
+    max_size=int(os.environ.get("TOKEN_CACHE_MAX_SIZE", "1024")),
+    ttl=float(os.environ.get("TOKEN_CACHE_MAX_TTL", "3600")),
+)
+token_cache_negative_ttl = float(
+    os.environ.get("TOKEN_CACHE_NEGATIVE_TTL", "10")
+)
 
 sentry_dsn = os.environ.get("SENTRY_DSN")
 if sentry_dsn:
@@ -30,36 +66,56 @@ class UnverifiedError(Exception):
         self.message = message
 
 
-def verify_token(token: str) -> bool:
-    response = requests.get(
-        url="https://api.line.me/oauth2/v2.1/verify",
-        params={
-            "access_token": token,
-        },
-    )
-    response_json = response.json()
+class InvalidTokenError(UnverifiedError):
+    pass
+
+
+def verify_token(token: str) -> typing.Dict[str, typing.Any]:
+    try:
+        response = session.get(
+            url=f"{line_api_base_url}/oauth2/v2.1/verify",
+            params={
+                "access_token": token,
+            },
+            timeout=line_api_timeout,
+        )
+        response_json = response.json()
+    except (requests.RequestException, ValueError):
+        # timeouts and connection errors deny without being cached
+        logger.exception("failed to verify token")
+        raise UnverifiedError("failed to verify token")
     logger.debug(response_json)
 
     if response.status_code == 200:
         if response_json["client_id"] == channel_id:
-            return True
+            return response_json
         else:
-            raise UnverifiedError("invalie access token")
+            raise InvalidTokenError("invalie access token")
     elif response.status_code == 400:
-        raise UnverifiedError(response_json["error_description"])
+        raise InvalidTokenError(response_json["error_description"])
 
     raise UnverifiedError("unknown authorization error")
 
 
 def get_profile(token: str) -> typing.Dict[str, typing.Union[str, None]]:
-    response = requests.get(
-        url="https://api.line.me/v2/profile",
-        headers={
-            "Authorization": f"Bearer {token}",
-        },
-    )
-    response_json = response.json()
+    try:
+        response = session.get(
+            url=f"{line_api_base_url}/v2/profile",
+            headers={
+                "Authorization": f"Bearer {token}",
+            },
+            timeout=line_api_timeout,
+        )
+        response_json = response.json()
+    except (requests.RequestException, ValueError):
+        logger.exception("failed to get profile")
+        raise UnverifiedError("failed to get profile")
     logger.debug(response_json)
+
+    # not an InvalidTokenError, so a transient failure is never cached
+    if response.status_code != 200 or not response_json.get("userId"):
+        raise UnverifiedError("failed to get profile")
+
     return {
         "user_id": response_json.get("userId"),
         "display_name": response_json.get("displayName"),
@@ -67,6 +123,102 @@ def get_profile(token: str) -> typing.Dict[str, typing.Union[str, None]]:
     }
 
 
+def is_id_token(token: str) -> bool:
+    # LINE access tokens are opaque or HS256; ID tokens are signed with ES256
+    try:
+        return jwt.get_unverified_header(token).get("alg") == "ES256"
+    except jwt.InvalidTokenError:
+        return False
+
+
+def verify_id_token(token: str) -> typing.Dict[str, typing.Any]:
+    try:
+        signing_key = jwks_client.get_signing_key_from_jwt(token)
+    except jwt.PyJWKClientConnectionError as e:
+        # the token may be fine; LINE's signing keys could not be fetched
+        logger.exception("failed to fetch signing keys")
+        raise UnverifiedError(str(e))
+    except jwt.PyJWKClientError as e:
+        # no key matches the token's kid, even after a refresh
+        raise InvalidTokenError(str(e))
+
+    try:
+        claims = jwt.decode(
+            token,
+            signing_key.key,
+            algorithms=["ES256"],
+            audience=channel_id,
+            issuer=line_id_token_issuer,
+            options={"require": ["exp", "sub"]},
+        )
+    except jwt.InvalidTokenError as e:
+        raise InvalidTokenError(str(e))
+    logger.debug(claims)
+    return claims
+
+
+def authorize_id_token(
+    key: str,
+    token: str,
+) -> typing.Dict[str, typing.Union[str, None]]:
+    try:
+        claims = verify_id_token(token)
+    except InvalidTokenError as e:
+        token_cache.set(
+            key,
+            (False, e.message),
+            ttl=token_cache_negative_ttl,
+        )
+        raise
+
+    profile = {
+        "user_id": claims["sub"],
+        "display_name": claims.get("name"),
+        "picture_url": claims.get("picture"),
+    }
+    token_cache.set(
+        key,
+        (True, profile),
+        ttl=min(claims["exp"] - time.time(), token_cache.ttl),
+    )
+    return profile
+
+
+def authorize(token: str) -> typing.Dict[str, typing.Union[str, None]]:
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        allow, value = cached
+        if not allow:
+            raise InvalidTokenError(value)
+        return value
+
+    if is_id_token(token):
+        return authorize_id_token(key, token)
+
+    # the profile is fetched while the token is verified and only used once
+    # the verification succeeds
+    profile_future = executor.submit(get_profile, token)
+    try:
+        verify_response = verify_token(token)
+    except InvalidTokenError as e:
+        # a short negative entry keeps bursts of bad tokens off LINE
+        token_cache.set(
+            key,
+            (False, e.message),
+            ttl=token_cache_negative_ttl,
+        )
+        raise
+
+    profile = profile_future.result()
+    token_cache.set(
+        key,
+        (True, profile),
+        ttl=min(float(verify_response["expires_in"]), token_cache.ttl),
+    )
+    return profile
+
+
 def generate_policy(
     event,
     principal_id: str,
@@ -95,6 +247,7 @@ def generate_policy(
     return policy
 
 
+@metrics.log_metrics
 @tracer.capture_lambda_handler
 def lambda_handler(event, context) -> typing.Dict[str, typing.Any]:
     logger.debug(event)
@@ -107,14 +260,19 @@ def lambda_handler(event, context) -> typing.Dict[str, typing.Any]:
         context["message"] = "Authorization type is not Bearer"
     else:
         token = token.split(" ", 1)[1]
+        hits = token_cache.hits
         try:
-            verify = verify_token(token)
+            context = authorize(token)
+            verify = True
         except UnverifiedError as e:
             verify = False
             context["message"] = e.message
-
-    if verify:
-        context = get_profile(token)
+        if token_cache.hits > hits:
+            metrics.add_metric("TokenCacheHit", MetricUnit.Count, 1)
+        else:
+            metrics.add_metric("TokenCacheMiss", MetricUnit.Count, 1)
+    metrics.add_metric("TokenCacheSize", MetricUnit.Count, len(token_cache))
+    logger.debug({"token_cache": token_cache.stats()})
 
     return generate_policy(
         event,
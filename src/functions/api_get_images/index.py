@@ -1,5 +1,15 @@
+import base64
+from datetime import (
+    datetime,
+    timezone,
+)
+import hashlib
+import hmac
+from io import StringIO
 import json
+import math
 import os
+import time
 import typing
 
 from aws_lambda_powertools import (
@@ -17,13 +27,19 @@ from aws_lambda_powertools.event_handler.api_gateway import (
 import sentry_sdk
 from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
 
-from models import image
+from models import (
+    image,
+    user_version,
+)
+from utils.ttl_cache import TTLCache
 
 
 tracer = Tracer()
 logger = Logger()
 
-cors_config = CORSConfig()
+cors_config = CORSConfig(
+    expose_headers=["ETag", "X-Content-Length", "X-Next-Cursor"],
+)
 app = ApiGatewayResolver(cors=cors_config)
 
 sentry_dsn = os.environ.get("SENTRY_DSN")
@@ -42,21 +58,292 @@ image_prefix = os.environ["IMAGE_PREFIX"]
 if image_prefix.endswith("/"):
     image_prefix = image_prefix[:-1]
 
+cursor_secret = os.environ["CURSOR_SECRET"].encode()
+
+image_url_secret = os.environ["IMAGE_URL_SECRET"].encode()
+image_url_ttl = int(os.environ.get("IMAGE_URL_TTL", "3600"))
+# expiry times are rounded up so URLs, ETags and cached listings stay
+# stable within a step
+image_url_expires_step = int(os.environ.get("IMAGE_URL_EXPIRES_STEP", "300"))
+
+MAX_LIMIT = 1000
+# Lambda returns at most 6 MB, including the JSON escaping of the body;
+# rendering stops past this instead of building a body that cannot be sent
+MAX_BODY_SIZE = 5 * 1024 * 1024
+
+json_encoder = json.JSONEncoder(separators=(",", ":"))
+
+# listings rendered by this container, keyed by user, listing version and
+# query; writes bump the version, which leaves older entries unreachable
+listing_cache = TTLCache(
+    max_size=int(os.environ.get("LISTING_CACHE_MAX_SIZE", "128")),
+    ttl=float(os.environ.get("LISTING_CACHE_TTL", "30")),
+)
+listing_cache_max_body = int(
+    os.environ.get("LISTING_CACHE_MAX_BODY", str(256 * 1024))
+)
+
+
+class BadRequestError(Exception):
+    def __init__(self, message: str, *args: object) -> None:
+        super().__init__(*args)
+        self.message = message
+
+
+def b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).decode().rstrip("=")
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def sign_cursor(scope: str, payload: str) -> str:
+    return b64encode(
+        hmac.new(
+            cursor_secret,
+            f"{scope}:{payload}".encode(),
+            hashlib.sha256,
+        ).digest()
+    )
+
+
+def encode_cursor(scope: str, key: typing.Dict[str, typing.Any]) -> str:
+    payload = b64encode(json.dumps(key, separators=(",", ":")).encode())
+    return f"{payload}.{sign_cursor(scope, payload)}"
+
+
+def decode_cursor(scope: str, cursor: str) -> typing.Dict[str, typing.Any]:
+    payload, _, signature = cursor.partition(".")
+    # compared as bytes; compare_digest raises on non-ASCII strings
+    if not hmac.compare_digest(
+        signature.encode(),
+        sign_cursor(scope, payload).encode(),
+    ):
+        raise BadRequestError("invalid cursor")
+    try:
+        return json.loads(b64decode(payload))
+    except ValueError:
+        raise BadRequestError("invalid cursor")
+
+
+def get_limit() -> typing.Optional[int]:
+    # without a limit the whole gallery is returned, as it was before
+    # pagination, so clients that do not page are never cut short
+    limit = app.current_event.get_query_string_value("limit")
+    if limit is None:
+        return None
+    try:
+        value = int(limit)
+    except ValueError:
+        raise BadRequestError("limit must be an integer")
+    if not 1 <= value <= MAX_LIMIT:
+        raise BadRequestError(f"limit must be between 1 and {MAX_LIMIT}")
+    return value
+
+
+def get_order() -> typing.Optional[str]:
+    order = app.current_event.get_query_string_value("order")
+    if order not in (None, "asc", "desc"):
+        raise BadRequestError("order must be asc or desc")
+    return order
+
+
+def get_timestamp(name: str) -> typing.Optional[float]:
+    value = app.current_event.get_query_string_value(name)
+    if value is None:
+        return None
+    try:
+        timestamp = float(value)
+    except ValueError:
+        try:
+            created = datetime.fromisoformat(value.replace("Z", "+00:00"))
+        except ValueError:
+            raise BadRequestError(f"{name} must be ISO 8601 or UNIX time")
+        if created.tzinfo is None:
+            created = created.replace(tzinfo=timezone.utc)
+        timestamp = created.timestamp()
+    if not math.isfinite(timestamp):
+        raise BadRequestError(f"{name} must be ISO 8601 or UNIX time")
+    return timestamp
+
+
+def get_image_url_expires() -> int:
+    expires = int(time.time()) + image_url_ttl
+    return -(-expires // image_url_expires_step) * image_url_expires_step
+
+
+def get_etag(user_id: str, version: int, url_expires: int) -> str:
+    query = app.current_event.query_string_parameters or {}
+    digest = hashlib.sha256(
+        json.dumps(
+            [user_id, version, url_expires, sorted(query.items())],
+            separators=(",", ":"),
+        ).encode()
+    ).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def match_etag(etag: str) -> bool:
+    if_none_match = app.current_event.get_header_value("If-None-Match")
+    if not if_none_match:
+        return False
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        if value in ("*", etag):
+            return True
+    return False
+
+
+def write_json_array(
+    fp: typing.TextIO,
+    values: typing.Iterable[typing.Any],
+    max_size: typing.Optional[int] = None,
+) -> int:
+    count = 0
+    fp.write("[")
+    for value in values:
+        if count:
+            fp.write(",")
+        fp.write(json_encoder.encode(value))
+        count += 1
+        if max_size is not None and fp.tell() > max_size:
+            raise BadRequestError(
+                "too many images for one response, request pages with limit"
+            )
+    fp.write("]")
+    return count
+
+
+def render_listing(
+    items,
+    cursor_scope: str,
+    url_expires: int,
+) -> typing.Tuple[str, int, typing.Optional[str]]:
+    # items are converted and encoded one at a time while the query result
+    # is consumed, so no list of models or dicts is built for the page
+    with StringIO() as body:
+        count = write_json_array(
+            body,
+            (
+                image.convert_respones_image(
+                    item,
+                    image_base_url,
+                    image_prefix,
+                    url_secret=image_url_secret,
+                    url_expires=url_expires,
+                )
+                for item in items
+            ),
+            max_size=MAX_BODY_SIZE,
+        )
+        next_cursor = None
+        if items.last_evaluated_key:
+            next_cursor = encode_cursor(cursor_scope, items.last_evaluated_key)
+        return body.getvalue(), count, next_cursor
+
+
+def bad_request(e: BadRequestError) -> Response:
+    return Response(
+        status_code=400,
+        content_type="application/json",
+        body=json.dumps({"message": e.message}),
+    )
+
+
+def get_user_id() -> str:
+    authorizer = app.current_event["requestContext"]["authorizer"]
+    return authorizer.get("user_id") or authorizer["principalId"]
+
 
 @app.get("/images")
 @tracer.capture_method
 def get_handler():
-    images = [
-        image.convert_respones_image(item, image_base_url, image_prefix)
-        for item in image.get_all_items()
-    ]
+    user_id = get_user_id()
+    cursor = app.current_event.get_query_string_value("cursor")
+    try:
+        limit = get_limit()
+        order = get_order()
+        since = get_timestamp("since")
+        until = get_timestamp("until")
+        # DynamoDB rejects a BETWEEN whose bounds are reversed
+        if since is not None and until is not None and since > until:
+            raise BadRequestError("since must not be later than until")
+        # a cursor is only valid for the user and ordering it was issued for
+        cursor_scope = f"{user_id}:{order}:{since}:{until}"
+        last_evaluated_key = None
+        if cursor:
+            last_evaluated_key = decode_cursor(cursor_scope, cursor)
+    except BadRequestError as e:
+        return bad_request(e)
+
+    # every write of an image row bumps the user's version, so a single
+    # GetItem decides whether the client's copy of this listing is current
+    version = user_version.get_version(user_id)
+    # signed image URLs are part of the body, so their expiry is part of
+    # the ETag as well
+    url_expires = get_image_url_expires()
+    etag = get_etag(user_id, version, url_expires)
+    cache_headers = {
+        "ETag": etag,
+        "Cache-Control": "private, no-cache",
+    }
+    if match_etag(etag):
+        return Response(
+            status_code=304,
+            content_type="application/json",
+            body="",
+            headers=cache_headers,
+        )
+
+    cache_key = (user_id, version, etag)
+    listing = listing_cache.get(cache_key)
+    if listing is None:
+        # entries of older versions can never be hit again
+        listing_cache.invalidate(
+            lambda key: key[0] == user_id and key[1] != version
+        )
+        if order or since is not None or until is not None:
+            items = image.get_user_items_by_created(
+                user_id,
+                newest_first=order == "desc",
+                since=since,
+                until=until,
+                limit=limit,
+                last_evaluated_key=last_evaluated_key,
+                attributes_to_get=image.RESPONSE_ATTRIBUTES,
+            )
+        else:
+            items = image.get_user_items(
+                user_id,
+                limit=limit,
+                last_evaluated_key=last_evaluated_key,
+                attributes_to_get=image.RESPONSE_ATTRIBUTES,
+            )
+        try:
+            listing = render_listing(items, cursor_scope, url_expires)
+        except BadRequestError as e:
+            return bad_request(e)
+        if len(listing[0]) <= listing_cache_max_body:
+            listing_cache.set(cache_key, listing)
+    logger.debug({"listing_cache": listing_cache.stats()})
+
+    body, count, next_cursor = listing
+    # the body stays a plain array of images; the cursor of the next page
+    # travels in a header like the count
+    headers = {
+        "X-Content-Length": count,
+        **cache_headers,
+    }
+    if next_cursor:
+        headers["X-Next-Cursor"] = next_cursor
     return Response(
         status_code=200,
         content_type="application/json",
-        body=json.dumps(images, separators=(",", ":")),
-        headers={
-            "X-Content-Length": len(images),
-        },
+        body=body,
+        headers=headers,
     )
 
 
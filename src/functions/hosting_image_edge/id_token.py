@@ -0,0 +1,149 @@
+import base64
+import hashlib
+import json
+import time
+import typing
+from urllib import (
+    error,
+    request,
+)
+
+import ecdsa
+from ecdsa.errors import MalformedPointError
+
+
+ISSUER = "https://access.line.me"
+
+# minimum interval between signing key refreshes triggered by unknown kids
+KEYS_REFRESH_INTERVAL = 60.0
+
+_keys: typing.Dict[str, ecdsa.VerifyingKey] = {}
+_keys_fetched_at = 0.0
+
+
+class InvalidIdTokenError(Exception):
+    pass
+
+
+class SigningKeysUnavailableError(Exception):
+    # the token may be fine; LINE's signing keys could not be fetched
+    pass
+
+
+def b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+def load_jwk(jwk: typing.Dict[str, typing.Any]) -> ecdsa.VerifyingKey:
+    if jwk.get("kty") != "EC" or jwk.get("crv") != "P-256":
+        raise ValueError("unsupported key type")
+    # raises MalformedPointError unless the point is on P-256
+    return ecdsa.VerifyingKey.from_string(
+        b64decode(jwk["x"]).rjust(32, b"\0")
+        + b64decode(jwk["y"]).rjust(32, b"\0"),
+        curve=ecdsa.NIST256p,
+    )
+
+
+def verify_es256(
+    key: ecdsa.VerifyingKey,
+    message: bytes,
+    signature: bytes,
+) -> bool:
+    # JWS carries the raw 64 byte r || s, not a DER sequence
+    try:
+        return key.verify(
+            signature,
+            message,
+            hashfunc=hashlib.sha256,
+            sigdecode=ecdsa.util.sigdecode_string,
+        )
+    except (ecdsa.BadSignatureError, ecdsa.util.MalformedSignature):
+        return False
+
+
+def fetch_keys(
+    jwks_url: str,
+    timeout: float,
+) -> typing.Dict[str, ecdsa.VerifyingKey]:
+    with request.urlopen(jwks_url, timeout=timeout) as res:
+        jwks = json.load(res)
+
+    keys = {}
+    for jwk in jwks.get("keys", []):
+        try:
+            keys[jwk["kid"]] = load_jwk(jwk)
+        except (KeyError, ValueError, MalformedPointError):
+            pass
+    return keys
+
+
+def get_signing_key(
+    kid: str,
+    jwks_url: str,
+    timeout: float,
+) -> ecdsa.VerifyingKey:
+    global _keys, _keys_fetched_at
+
+    if kid not in _keys:
+        now = time.monotonic()
+        if now - _keys_fetched_at >= KEYS_REFRESH_INTERVAL or not _keys:
+            try:
+                _keys = fetch_keys(jwks_url, timeout)
+            except (error.URLError, OSError, ValueError):
+                raise SigningKeysUnavailableError(
+                    "signing keys are unavailable"
+                )
+            _keys_fetched_at = now
+
+    try:
+        return _keys[kid]
+    except KeyError:
+        raise InvalidIdTokenError("unknown signing key")
+
+
+def get_header(token: str) -> typing.Dict[str, typing.Any]:
+    try:
+        header = json.loads(b64decode(token.split(".", 1)[0]))
+    except ValueError:
+        return {}
+    return header if isinstance(header, dict) else {}
+
+
+def is_id_token(token: str) -> bool:
+    # LINE access tokens are opaque or HS256; ID tokens are signed with ES256
+    return token.count(".") == 2 and get_header(token).get("alg") == "ES256"
+
+
+def verify(
+    token: str,
+    audience: str,
+    jwks_url: str,
+    timeout: float = 0.5,
+) -> typing.Dict[str, typing.Any]:
+    try:
+        header_b64, payload_b64, signature_b64 = token.split(".")
+        signature = b64decode(signature_b64)
+        claims = json.loads(b64decode(payload_b64))
+    except ValueError:
+        raise InvalidIdTokenError("malformed token")
+
+    header = get_header(token)
+    if header.get("alg") != "ES256":
+        raise InvalidIdTokenError("unsupported algorithm")
+
+    key = get_signing_key(header.get("kid"), jwks_url, timeout)
+    message = f"{header_b64}.{payload_b64}".encode()
+    if not verify_es256(key, message, signature):
+        raise InvalidIdTokenError("invalid signature")
+
+    if not isinstance(claims, dict) or claims.get("iss") != ISSUER:
+        raise InvalidIdTokenError("invalid issuer")
+    aud = claims.get("aud")
+    if aud != audience and not (isinstance(aud, list) and audience in aud):
+        raise InvalidIdTokenError("invalid audience")
+    exp = claims.get("exp")
+    if not isinstance(exp, (int, float)) or exp <= time.time():
+        raise InvalidIdTokenError("token is expired")
+
+    return claims
@@ -1,10 +1,17 @@
+import base64
 from distutils.util import strtobool
+import functools
+import hashlib
+import hmac
+import http.client
+import json
+import os
+import time
 import typing
-from urllib import (
-    error,
-    parse,
-    request,
-)
+from urllib import parse
+
+import id_token
+from ttl_cache import TTLCache
 
 
 FORBIDDEN_RESPONSE = {
@@ -13,34 +20,302 @@ FORBIDDEN_RESPONSE = {
     "body": "Forbidden",
 }
 
-save_image_prefix = ".images"
-hosting_image_prefix = "images"
+
+def load_config() -> typing.Dict[str, typing.Any]:
+    # Lambda@Edge has no environment variables; HostingImageStack writes
+    # the settings into the deployed asset instead
+    path = os.path.join(os.path.dirname(__file__), "config.json")
+    try:
+        with open(path) as fp:
+            return json.load(fp)
+    except FileNotFoundError:
+        return {}
+
+
+config = load_config()
+
+save_image_prefix = config.get("save_image_prefix", ".images")
+hosting_image_prefix = config.get("hosting_image_prefix", "images")
+line_login_channel_id = config.get("line_login_channel_id")
+line_api_base_url = config.get("line_api_base_url", "https://api.line.me")
+line_api_timeout = float(config.get("line_api_timeout", 0.3))
+image_url_secret = config.get("image_url_secret", "").encode()
+
+line_api = parse.urlsplit(line_api_base_url)
+# reused by warm containers so a page of images pays for one TLS handshake
+line_api_connection: typing.Optional[http.client.HTTPConnection] = None
+
+# verification results keyed by a hash of the token; a page requesting
+# dozens of images hits LINE once
+token_cache = TTLCache(
+    max_size=int(config.get("token_cache_max_size", 1024)),
+    ttl=float(config.get("token_cache_max_ttl", 300)),
+)
+token_cache_negative_ttl = float(config.get("token_cache_negative_ttl", 10))
+
+# width buckets of resized variants; variants missing from the bucket are
+# generated by the fallback origin on first request
+image_widths = sorted(int(w) for w in config.get("image_widths", [400]))
+thumbnail_width = 400
 
 path_map = {
-    # (support_webp, thumbnail): path
-    (True, True): "webp/400/",
-    (True, False): "webp/original_size/",
-    (False, True): "original_format/400/",
-    (False, False): "original/",
+    # format: (original size path, resized path)
+    "avif": ("avif/original_size/", "avif/{width}/"),
+    "webp": ("webp/original_size/", "webp/{width}/"),
+    "original": ("original/", "original_format/{width}/"),
 }
 
+# derived formats in order of preference when clients rate them equally
+derived_formats = [
+    ("avif", "image/avif"),
+    ("webp", "image/webp"),
+]
+
+
+def _line_api_request(path: str) -> typing.Tuple[int, bytes]:
+    global line_api_connection
 
-def verify_token(token: str) -> bool:
-    endpoint = "https://api.line.me/oauth2/v2.1/verify"
+    if line_api_connection is None:
+        connection_class = (
+            http.client.HTTPSConnection
+            if line_api.scheme == "https"
+            else http.client.HTTPConnection
+        )
+        line_api_connection = connection_class(
+            line_api.netloc,
+            timeout=line_api_timeout,
+        )
+    try:
+        line_api_connection.request("GET", line_api.path + path)
+        response = line_api_connection.getresponse()
+        return response.status, response.read()
+    except (http.client.HTTPException, OSError):
+        line_api_connection.close()
+        line_api_connection = None
+        raise
+
+
+def line_api_get(path: str) -> typing.Tuple[int, bytes]:
+    try:
+        return _line_api_request(path)
+    except (ConnectionResetError, BrokenPipeError):
+        # the kept-alive connection was closed by LINE; reconnect once
+        return _line_api_request(path)
+
+
+def verify_token(token: str) -> typing.Tuple[bool, float]:
+    # returns whether the token is valid and how long that may be cached
     params = {
         "access_token": token,
     }
-    url = f"{endpoint}?{parse.urlencode(params)}"
+    try:
+        status, body = line_api_get(
+            f"/oauth2/v2.1/verify?{parse.urlencode(params)}"
+        )
+    except (http.client.HTTPException, OSError):
+        return False, 0.0
+
+    if status == 400:
+        return False, token_cache_negative_ttl
+    if status != 200:
+        return False, 0.0
+
+    try:
+        response_json = json.loads(body)
+    except ValueError:
+        return False, 0.0
+    if (
+        line_login_channel_id
+        and response_json.get("client_id") != line_login_channel_id
+    ):
+        return False, token_cache_negative_ttl
+
+    return True, float(response_json.get("expires_in", 0))
 
-    req = request.Request(url)
+
+def verify_id_token(token: str) -> typing.Tuple[bool, float]:
+    if not line_login_channel_id:
+        return False, 0.0
     try:
-        with request.urlopen(req) as res:
-            if res.getcode() != 200:
-                return False
-    except (error.HTTPError, error.URLError):
+        claims = id_token.verify(
+            token,
+            audience=line_login_channel_id,
+            jwks_url=f"{line_api_base_url}/oauth2/v2.1/certs",
+            timeout=line_api_timeout,
+        )
+    except id_token.SigningKeysUnavailableError:
+        # transient, so the next request tries to fetch the keys again
+        return False, 0.0
+    except id_token.InvalidIdTokenError:
+        return False, token_cache_negative_ttl
+    return True, claims["exp"] - time.time()
+
+
+def authorize(token: str) -> bool:
+    key = hashlib.sha256(token.encode()).hexdigest()
+    cached = token_cache.get(key)
+    if cached is not None:
+        return cached
+
+    if id_token.is_id_token(token):
+        # ID tokens are verified locally against LINE's cached signing keys
+        verified, ttl = verify_id_token(token)
+    else:
+        verified, ttl = verify_token(token)
+    token_cache.set(key, verified, ttl=min(ttl, token_cache.ttl))
+    return verified
+
+
+def sign_image_path(user_id: str, path: str, expires: int) -> str:
+    # must match utils.signed_url.sign_image_path in the API layer
+    digest = hmac.new(
+        image_url_secret,
+        f"{user_id}\n{path}\n{expires}".encode(),
+        hashlib.sha256,
+    ).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
+
+
+def verify_signed_url(request: typing.Dict[str, typing.Any]) -> bool:
+    if not image_url_secret:
         return False
 
-    return True
+    query = parse.parse_qs(request["querystring"])
+    expires = query.get("expires", [""])[0]
+    signature = query.get("signature", [""])[0]
+    # isdigit alone accepts characters such as "²" that int() rejects
+    if not (expires.isascii() and expires.isdigit() and signature):
+        return False
+    if int(expires) < time.time():
+        return False
+
+    # the signature binds the user id in the path, so a URL issued for one
+    # user's image cannot be rewritten to another's
+    uri: str = request["uri"]
+    prefix = f"/{hosting_image_prefix}/"
+    parts = uri[len(prefix) :].split("/")
+    if not uri.startswith(prefix) or len(parts) != 2:
+        return False
+
+    # compared as bytes; compare_digest raises on non-ASCII strings
+    return hmac.compare_digest(
+        signature.encode(),
+        sign_image_path(parts[0], uri, int(expires)).encode(),
+    )
+
+
+def parse_accept(accept: str) -> typing.Dict[str, float]:
+    media_ranges = {}
+    for media_range in accept.split(","):
+        media_type, *params = media_range.split(";")
+        media_type = media_type.strip().lower()
+        if not media_type:
+            continue
+
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = min(max(float(value), 0.0), 1.0)
+                except ValueError:
+                    q = 0.0
+        media_ranges[media_type] = max(q, media_ranges.get(media_type, 0.0))
+    return media_ranges
+
+
+@functools.lru_cache(maxsize=256)
+def negotiate_format(accept: str) -> str:
+    media_ranges = parse_accept(accept)
+
+    # the original is served to anything accepting images at all; derived
+    # formats count only when listed explicitly, because browsers sending
+    # bare wildcards may not be able to decode them
+    original_q = max(
+        media_ranges.get("image/jpeg", 0.0),
+        media_ranges.get("image/png", 0.0),
+        media_ranges.get("image/*", 0.0),
+        media_ranges.get("*/*", 0.0),
+    )
+
+    best_format, best_q = "original", 0.0
+    for format, media_type in derived_formats:
+        q = media_ranges.get(media_type, 0.0)
+        if q > best_q:
+            best_format, best_q = format, q
+    if best_q == 0.0 or best_q < original_q:
+        return "original"
+    return best_format
+
+
+def get_header_value(
+    headers: typing.Dict[str, typing.Any],
+    name: str,
+) -> typing.Optional[str]:
+    return headers.get(name, [{"value": None}])[0]["value"]
+
+
+def parse_positive_number(
+    value: typing.Optional[str],
+) -> typing.Optional[float]:
+    if value is None:
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if 0 < number < float("inf") else None
+
+
+def select_format(
+    query: typing.Dict[str, typing.List[str]],
+    headers: typing.Dict[str, typing.Any],
+) -> str:
+    # variant urls of the listing name their format explicitly
+    format = query.get("format", [None])[0]
+    if format in path_map:
+        return format
+
+    accept: str = headers.get("accept", [{"value": "*/*"}])[0]["value"]
+    return negotiate_format(accept)
+
+
+def select_width(
+    query: typing.Dict[str, typing.List[str]],
+    headers: typing.Dict[str, typing.Any],
+) -> typing.Optional[int]:
+    # variant urls of the listing also name their stored size, which
+    # bypasses ?w= and the width hints
+    size = query.get("size", [None])[0]
+    if size == "original":
+        return None
+    if size and size.isdigit() and int(size) in image_widths:
+        return int(size)
+
+    width = parse_positive_number(query.get("w", [None])[0])
+    if width is not None:
+        # ?w= is given in CSS pixels, so it is scaled by the DPR hint
+        dpr = parse_positive_number(
+            get_header_value(headers, "sec-ch-dpr")
+            or get_header_value(headers, "dpr")
+        )
+        width *= dpr or 1.0
+    elif strtobool(query.get("thumbnail", ["false"])[0]):
+        return thumbnail_width
+    else:
+        # the Width hint is already in physical pixels
+        width = parse_positive_number(
+            get_header_value(headers, "sec-ch-width")
+            or get_header_value(headers, "width")
+        )
+    if width is None:
+        return None
+
+    for image_width in image_widths:
+        if image_width >= width:
+            return image_width
+    # wider than the largest bucket: serve the original size
+    return None
 
 
 def change_origin_request(
@@ -52,18 +327,15 @@ def change_origin_request(
         return request
 
     headers = request["headers"]
-    accept: str = headers.get("accept", [{"value": "*/*"}])[0]["value"]
-    support_webp = False
-    try:
-        accept.split(";")[0].split(",").index("image/webp")
-        support_webp = True
-    except ValueError:
-        pass
-
     query = parse.parse_qs(request["querystring"])
-    thumbnail = strtobool(query.get("thumbnail", ["false"])[0])
+    format = select_format(query, headers)
+    width = select_width(query, headers)
 
-    new_uri = f"/{save_image_prefix}/" + path_map[support_webp, thumbnail]
+    original_size_path, resized_path = path_map[format]
+    if width is None:
+        new_uri = f"/{save_image_prefix}/{original_size_path}"
+    else:
+        new_uri = f"/{save_image_prefix}/" + resized_path.format(width=width)
 
     user_id, image_id = uri[len(hosting_image_prefix) + 2 :].split("/")
     new_uri += f"{user_id}/{image_id}"
@@ -76,9 +348,11 @@ def change_origin_request(
 def lambda_handler(event, context) -> typing.Dict[str, typing.Any]:
     request = event["Records"][0]["cf"]["request"]
 
+    signed = verify_signed_url(request)
+
     request = change_origin_request(request)
 
-    if request["method"] == "OPTIONS":
+    if request["method"] == "OPTIONS" or signed:
         return request
 
     headers = request["headers"]
@@ -90,7 +364,7 @@ def lambda_handler(event, context) -> typing.Dict[str, typing.Any]:
         return FORBIDDEN_RESPONSE
 
     token = authorization.split(" ", 1)[1]
-    if not verify_token(token):
+    if not authorize(token):
         return FORBIDDEN_RESPONSE
 
     return request
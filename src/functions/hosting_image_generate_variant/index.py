@@ -0,0 +1,211 @@
+import base64
+from io import BytesIO
+import hmac
+import os
+import typing
+
+from aws_lambda_powertools import (
+    Logger,
+    Tracer,
+)
+import boto3
+from botocore.exceptions import ClientError
+from PIL import Image
+import pillow_avif  # noqa: F401
+import sentry_sdk
+from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+
+tracer = Tracer()
+logger = Logger()
+
+sentry_dsn = os.environ.get("SENTRY_DSN")
+if sentry_dsn:
+    sentry_sdk.init(
+        dsn=sentry_dsn,
+        integrations=[AwsLambdaIntegration()],
+        traces_sample_rate=1.0,
+    )
+
+save_image_prefix = os.environ["SAVE_IMAGE_PREFIX"]
+if save_image_prefix.endswith("/"):
+    save_image_prefix = save_image_prefix[:-1]
+
+bucket_name = os.environ["BUCKET_NAME"]
+image_widths = [int(w) for w in os.environ["IMAGE_WIDTHS"].split(",")]
+origin_secret = os.environ["ORIGIN_SECRET"]
+
+s3 = boto3.client("s3")
+
+table_name = os.environ["TABLE_NAME"]
+version_table_name = os.environ["VERSION_TABLE_NAME"]
+dynamodb = boto3.client("dynamodb")
+
+# variant directory: PIL format (None keeps the format of the original)
+variant_formats = {
+    "original_format": None,
+    "webp": "WEBP",
+    "avif": "AVIF",
+}
+
+# PIL save options per format, the same as line_webhook_save_derivatives
+save_options = {
+    "AVIF": {"quality": 55},
+}
+
+NOT_FOUND_RESPONSE = {
+    "statusCode": 404,
+    "headers": {"Content-Type": "text/plain"},
+    "body": "Not Found",
+}
+
+
+def parse_variant_key(
+    path: str,
+) -> typing.Optional[typing.Tuple[str, typing.Optional[int], str, str]]:
+    parts = path.strip("/").split("/")
+    if len(parts) != 5 or parts[0] != save_image_prefix:
+        return None
+
+    _, variant, size, user_id, image_id = parts
+    if variant not in variant_formats:
+        return None
+    if size == "original_size" and variant != "original_format":
+        return variant, None, user_id, image_id
+    if size.isdigit() and int(size) in image_widths:
+        return variant, int(size), user_id, image_id
+    return None
+
+
+def generate_variant(
+    variant: str,
+    width: typing.Optional[int],
+    user_id: str,
+    image_id: str,
+) -> typing.Optional[typing.Tuple[bytes, str, typing.Tuple[int, int]]]:
+    # a plain GET; download_fileobj would HEAD the object for its size first
+    try:
+        get_response = s3.get_object(
+            Bucket=bucket_name,
+            Key="/".join([save_image_prefix, "original", user_id, image_id]),
+        )
+    except ClientError as e:
+        if e.response["Error"]["Code"] == "NoSuchKey":
+            return None
+        raise
+
+    with BytesIO(get_response["Body"].read()) as rbuf:
+        with Image.open(rbuf) as image, BytesIO() as wbuf:
+            format = variant_formats[variant] or image.format
+            if width is not None:
+                # thumbnail() already decodes JPEGs at a reduced DCT scale
+                # and box-reduces before the final resample
+                image.thumbnail((width, width))
+            image.save(wbuf, format, **save_options.get(format, {}))
+            return wbuf.getvalue(), f"image/{format.lower()}", image.size
+
+
+def save_variant_info(
+    variant: str,
+    width: typing.Optional[int],
+    user_id: str,
+    image_id: str,
+    size: typing.Tuple[int, int],
+    byte_size: int,
+    content_type: str,
+) -> None:
+    # the map is created by the derivative worker at ingest
+    try:
+        dynamodb.update_item(
+            TableName=table_name,
+            Key={"UserId": {"S": user_id}, "ImageId": {"S": image_id}},
+            UpdateExpression="SET #variants.#variant = :variant",
+            ConditionExpression="attribute_exists(#variants)",
+            ExpressionAttributeNames={
+                "#variants": "Variants",
+                "#variant": f"{variant}/{width or 'original_size'}",
+            },
+            ExpressionAttributeValues={
+                ":variant": {
+                    "M": {
+                        "Width": {"N": str(size[0])},
+                        "Height": {"N": str(size[1])},
+                        "Size": {"N": str(byte_size)},
+                        "ContentType": {"S": content_type},
+                    }
+                },
+            },
+        )
+    except ClientError as e:
+        if (
+            e.response["Error"]["Code"]
+            != "ConditionalCheckFailedException"
+        ):
+            raise
+        logger.info("variants of the image are not recorded yet")
+        return
+
+    # bump the user's listing version so GET /images stops answering 304
+    dynamodb.update_item(
+        TableName=version_table_name,
+        Key={"UserId": {"S": user_id}},
+        UpdateExpression="ADD Version :increment",
+        ExpressionAttributeValues={":increment": {"N": "1"}},
+    )
+
+
+@tracer.capture_lambda_handler
+def lambda_handler(event, context) -> typing.Dict[str, typing.Any]:
+    logger.debug(event["path"])
+
+    # only CloudFront, which adds the origin secret, may trigger generation
+    headers = {k.lower(): v for k, v in (event.get("headers") or {}).items()}
+    if not hmac.compare_digest(
+        headers.get("x-origin-secret", ""),
+        origin_secret,
+    ):
+        return {
+            "statusCode": 403,
+            "headers": {"Content-Type": "text/plain"},
+            "body": "Forbidden",
+        }
+
+    variant_key = parse_variant_key(event["path"])
+    if variant_key is None:
+        return NOT_FOUND_RESPONSE
+
+    generated = generate_variant(*variant_key)
+    if generated is None:
+        return NOT_FOUND_RESPONSE
+    body, content_type, size = generated
+
+    # persisted so later requests are served from the bucket directly
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=event["path"].strip("/"),
+        Body=body,
+        ContentType=content_type,
+    )
+    # best effort: the variant is already stored, so failing to record it
+    # must not fail the response
+    try:
+        save_variant_info(
+            *variant_key,
+            size=size,
+            byte_size=len(body),
+            content_type=content_type,
+        )
+    except Exception:
+        logger.exception("failed to save variant info")
+
+    # CloudFront caches this response, so it carries the same CORS header
+    # the bucket's CORS rule adds to later responses
+    return {
+        "statusCode": 200,
+        "headers": {
+            "Content-Type": content_type,
+            "Access-Control-Allow-Origin": "*",
+        },
+        "body": base64.b64encode(body).decode(),
+        "isBase64Encoded": True,
+    }
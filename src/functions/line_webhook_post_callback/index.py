@@ -14,22 +14,14 @@ from aws_lambda_powertools.event_handler.api_gateway import (
     Response,
 )
 import boto3
-from linebot import (
-    LineBotApi,
-    WebhookHandler,
-)
 from linebot.exceptions import (
     InvalidSignatureError,
 )
-from linebot.models import (
-    ImageMessage,
-    MessageEvent,
-    TextMessage,
-    TextSendMessage,
-)
 import sentry_sdk
 from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
 
+from webhook import events
+
 
 tracer = Tracer()
 logger = Logger()
@@ -43,12 +35,34 @@ if sentry_dsn:
         traces_sample_rate=1.0,
     )
 
-line_bot_api = LineBotApi(os.environ["CHANNEL_ACCESS_TOKEN"])
-handler = WebhookHandler(os.environ["CHANNEL_SECRET"])
-
-save_image_queue_url = os.environ["SAVE_IMAGE_QUEUE_URL"]
 sqs = boto3.client("sqs")
 
+# fast ack only validates the signature and queues the raw body; events are
+# parsed, dispatched and replied to by line_webhook_dispatch_events
+fast_ack = os.environ.get("FAST_ACK", "false").lower() == "true"
+webhook_event_queue_url = os.environ.get("WEBHOOK_EVENT_QUEUE_URL")
+
+
+def enqueue_webhook_body(body: str, signature: str):
+    validator = events.handler.parser.signature_validator
+    if not validator.validate(body, signature or ""):
+        return Response(
+            status_code=400,
+            content_type="application/json",
+            body=json.dumps({"message": "Invalid signature"}),
+        )
+
+    res = sqs.send_message(
+        QueueUrl=webhook_event_queue_url,
+        MessageBody=body,
+        MessageAttributes={
+            "Signature": {"DataType": "String", "StringValue": signature},
+        },
+    )
+    logger.debug(res)
+
+    return {"message": "OK"}
+
 
 @app.post("/callback")
 @tracer.capture_method
@@ -56,8 +70,11 @@ def post_handler():
     signature = app.current_event.get_header_value("X-Line-Signature")
     body = app.current_event.body
 
+    if fast_ack:
+        return enqueue_webhook_body(body, signature)
+
     try:
-        handler.handle(body, signature)
+        events.dispatch(body, signature or "")
     except InvalidSignatureError:
         return Response(
             status_code=400,
@@ -68,28 +85,6 @@ def post_handler():
     return {"message": "OK"}
 
 
-@handler.add(MessageEvent, message=TextMessage)
-def handle_text_message(event: MessageEvent) -> None:
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text=event.message.text),
-    )
-
-
-@handler.add(MessageEvent, message=ImageMessage)
-def handle_image_message(event: MessageEvent) -> None:
-    res = sqs.send_message(
-        QueueUrl=save_image_queue_url,
-        MessageBody=event.as_json_string(),
-    )
-    logger.debug(res)
-
-
-@handler.default()
-def handle_default(event) -> None:
-    logger.debug(event.as_json_dict())
-
-
 @logger.inject_lambda_context(
     correlation_id_path=correlation_paths.API_GATEWAY_REST,
 )
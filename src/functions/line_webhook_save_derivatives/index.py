@@ -0,0 +1,256 @@
+import base64
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import json
+import os
+import typing
+
+from aws_lambda_powertools import (
+    Logger,
+    Tracer,
+)
+from aws_lambda_powertools.utilities.batch import (
+    PartialSQSProcessor,
+    batch_processor,
+)
+import boto3
+from PIL import Image
+import pillow_avif  # noqa: F401
+import sentry_sdk
+from sentry_sdk import capture_exception
+from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+
+
+tracer = Tracer()
+logger = Logger()
+
+sentry_dsn = os.environ.get("SENTRY_DSN")
+if sentry_dsn:
+    sentry_sdk.init(
+        dsn=sentry_dsn,
+        integrations=[AwsLambdaIntegration()],
+        traces_sample_rate=1.0,
+    )
+
+save_image_prefix = os.environ["SAVE_IMAGE_PREFIX"]
+if save_image_prefix.endswith("/"):
+    save_image_prefix = save_image_prefix[:-1]
+
+s3 = boto3.client("s3")
+
+table_name = os.environ["TABLE_NAME"]
+version_table_name = os.environ["VERSION_TABLE_NAME"]
+dynamodb = boto3.client("dynamodb")
+
+THUMBNAIL_SIZE = 400
+PLACEHOLDER_SIZE = 16
+PLACEHOLDER_QUALITY = 50
+
+variants = [
+    # (directory, size, PIL format); None keeps the original format
+    ("webp", "original_size", "WEBP"),
+    ("avif", "original_size", "AVIF"),
+    ("original_format", str(THUMBNAIL_SIZE), None),
+    ("webp", str(THUMBNAIL_SIZE), "WEBP"),
+    ("avif", str(THUMBNAIL_SIZE), "AVIF"),
+]
+
+upload_executor = ThreadPoolExecutor(max_workers=len(variants))
+
+# PIL save options per format; at the plugin's default quality of 75 AVIF
+# came out larger than WebP at its default of 80, quality 55 gives about the
+# same PSNR as that WebP
+save_options = {
+    "AVIF": {"quality": 55},
+}
+
+
+def encode_image(image: Image.Image, format: str) -> bytes:
+    with BytesIO() as buf:
+        image.save(buf, format, **save_options.get(format, {}))
+        return buf.getvalue()
+
+
+def encode_placeholder(image: Image.Image) -> str:
+    # a tiny JPEG data URI that clients stretch and blur while loading
+    placeholder = image.convert("RGB")
+    placeholder.thumbnail((PLACEHOLDER_SIZE, PLACEHOLDER_SIZE))
+    with BytesIO() as buf:
+        placeholder.save(
+            buf, "JPEG", quality=PLACEHOLDER_QUALITY, optimize=True
+        )
+        return "data:image/jpeg;base64," + base64.b64encode(
+            buf.getvalue()
+        ).decode("ascii")
+
+
+def upload_image(
+    bucket_name: str,
+    object_key: str,
+    body: bytes,
+    content_type: str,
+    metadata: typing.Dict[str, str],
+) -> None:
+    s3.put_object(
+        Bucket=bucket_name,
+        Key=object_key,
+        Body=body,
+        ContentType=content_type,
+        Metadata=metadata,
+    )
+
+
+def parse_original_created(
+    record: typing.Dict[str, typing.Any],
+) -> typing.Dict[str, typing.Any]:
+    notification = json.loads(record["body"])
+    original_created = json.loads(notification["Message"])
+    logger.debug(original_created)
+    if "Records" not in original_created:
+        return original_created
+
+    # S3 event notifications queued before save_image published the envelope
+    create_object_event = original_created["Records"][0]
+    bucket_name = create_object_event["s3"]["bucket"]["name"]
+    object_key = create_object_event["s3"]["object"]["key"]
+
+    head_response = s3.head_object(Bucket=bucket_name, Key=object_key)
+    logger.debug(head_response)
+    metadata = head_response["Metadata"]
+    return {
+        "bucket": bucket_name,
+        "key": object_key,
+        "user_id": metadata["userid"],
+        "image_id": metadata["imageid"],
+        "created": float(metadata["created"]),
+        "content_type": head_response["ContentType"],
+        "size": head_response["ContentLength"],
+        "etag": head_response["ETag"].strip('"'),
+    }
+
+
+def record_handler(record: typing.Dict[str, typing.Any]):
+    original_created = parse_original_created(record)
+
+    bucket_name = original_created["bucket"]
+    object_key = original_created["key"]
+    # carried over to every derivative, as S3 returns it for the original
+    metadata = {
+        "userid": original_created["user_id"],
+        "imageid": original_created["image_id"],
+        "created": str(original_created["created"]),
+    }
+
+    # a plain GET; download_fileobj would HEAD the object for its size first
+    get_response = s3.get_object(Bucket=bucket_name, Key=object_key)
+    with BytesIO(get_response["Body"].read()) as rbuf:
+        # the original is decoded once; the original_size variants are
+        # encoded first, then the image is shrunk in place for the 400 px
+        # ones instead of keeping a full-size copy around
+        with Image.open(rbuf) as image:
+            image.load()
+            original_format = image.format
+            width, height = image.size
+
+            # encoding stays on this thread because PIL keeps encoder state
+            # on the image; uploads run while the next variant is encoded
+            futures = []
+            variant_items = {}
+            for directory, size, format in sorted(
+                variants, key=lambda variant: variant[1] != "original_size"
+            ):
+                if size != "original_size":
+                    # a no-op once the image is small enough
+                    image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+                format = format or original_format
+                body = encode_image(image, format)
+                content_type = f"image/{format.lower()}"
+                variant_items[f"{directory}/{size}"] = {
+                    "M": {
+                        "Width": {"N": str(image.width)},
+                        "Height": {"N": str(image.height)},
+                        "Size": {"N": str(len(body))},
+                        "ContentType": {"S": content_type},
+                    }
+                }
+                futures.append(
+                    upload_executor.submit(
+                        upload_image,
+                        bucket_name=bucket_name,
+                        object_key="/".join(
+                            [
+                                save_image_prefix,
+                                directory,
+                                size,
+                                metadata["userid"],
+                                metadata["imageid"],
+                            ]
+                        ),
+                        body=body,
+                        content_type=content_type,
+                        metadata=metadata,
+                    )
+                )
+            placeholder = encode_placeholder(image)
+            for future in futures:
+                future.result()
+
+    # written whole from the envelope, so it does not matter whether
+    # save_info has created the row yet; save_info only inserts rows that do
+    # not exist and never replaces this one
+    dynamodb.update_item(
+        TableName=table_name,
+        Key={
+            "UserId": {"S": original_created["user_id"]},
+            "ImageId": {"S": original_created["image_id"]},
+        },
+        UpdateExpression=(
+            "SET #created = :created, #content_type = :content_type,"
+            " #width = :width, #height = :height, #size = :size,"
+            " #placeholder = :placeholder, #variants = :variants"
+        ),
+        ExpressionAttributeNames={
+            "#created": "Created",
+            "#content_type": "ContentType",
+            "#width": "Width",
+            "#height": "Height",
+            "#size": "Size",
+            "#placeholder": "Placeholder",
+            "#variants": "Variants",
+        },
+        ExpressionAttributeValues={
+            ":created": {"N": str(original_created["created"])},
+            ":content_type": {"S": original_created["content_type"]},
+            ":width": {"N": str(width)},
+            ":height": {"N": str(height)},
+            ":size": {"N": str(original_created["size"])},
+            ":placeholder": {"S": placeholder},
+            ":variants": {"M": variant_items},
+        },
+    )
+
+    # bump the user's listing version so GET /images stops answering 304
+    dynamodb.update_item(
+        TableName=version_table_name,
+        Key={"UserId": {"S": original_created["user_id"]}},
+        UpdateExpression="ADD Version :increment",
+        ExpressionAttributeValues={":increment": {"N": "1"}},
+    )
+
+
+class SQSProcessor(PartialSQSProcessor):
+    def failure_handler(
+        self, record: typing.Any, exception: typing.Tuple
+    ) -> typing.Tuple:
+        if sentry_dsn:
+            capture_exception()
+        logger.exception("got exception while processing SQS message")
+        return super().failure_handler(record, exception)
+
+
+@logger.inject_lambda_context
+@tracer.capture_lambda_handler
+@batch_processor(record_handler=record_handler, processor=SQSProcessor())
+def lambda_handler(event, context) -> typing.Dict[str, typing.Any]:
+    logger.debug(event)
+    return {"statusCode": 200}
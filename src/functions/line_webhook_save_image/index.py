@@ -1,4 +1,6 @@
-from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import io
 import json
 import os
 import typing
@@ -12,10 +14,15 @@ from aws_lambda_powertools.utilities.batch import (
     batch_processor,
 )
 import boto3
+from boto3.s3.transfer import TransferConfig
 from linebot import LineBotApi
 import sentry_sdk
 from sentry_sdk import capture_exception
 from sentry_sdk.integrations.aws_lambda import AwsLambdaIntegration
+from sentry_sdk.scope import (
+    use_isolation_scope,
+    use_scope,
+)
 
 
 tracer = Tracer()
@@ -38,6 +45,77 @@ if save_image_prefix.endswith("/"):
 bucket_name = os.environ["BUCKET_NAME"]
 s3 = boto3.client("s3")
 
+original_image_created_topic_arn = os.environ[
+    "ORIGINAL_IMAGE_CREATED_TOPIC_ARN"
+]
+sns = boto3.client("sns")
+
+# records are mostly I/O bound, so a batch is processed concurrently;
+# 1 falls back to processing records one at a time
+record_concurrency = int(os.environ.get("RECORD_CONCURRENCY", "10"))
+record_executor = ThreadPoolExecutor(max_workers=max(record_concurrency, 1))
+
+CONTENT_CHUNK_SIZE = 64 * 1024
+# S3 minimum part size; a non-seekable upload buffers up to
+# max_in_memory_upload_chunks parts, so about 20 MiB per record
+UPLOAD_PART_SIZE = 5 * 1024 * 1024
+UPLOAD_CONCURRENCY = 4
+transfer_config = TransferConfig(
+    multipart_threshold=UPLOAD_PART_SIZE,
+    multipart_chunksize=UPLOAD_PART_SIZE,
+    max_concurrency=UPLOAD_CONCURRENCY,
+)
+# an s3transfer setting boto3's TransferConfig does not take as an argument
+transfer_config.max_in_memory_upload_chunks = UPLOAD_CONCURRENCY
+
+
+class IterContentStream(io.RawIOBase):
+    def __init__(self, chunks: typing.Iterator[bytes]):
+        self._chunks = chunks
+        self._pending = b""
+        self.size = 0
+        self._md5 = hashlib.md5()
+        self._part_md5 = hashlib.md5()
+        self._part_digests: typing.List[bytes] = []
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._pending:
+            try:
+                self._pending = next(self._chunks)
+            except StopIteration:
+                return 0
+        # never crosses a part boundary, so each part can be hashed on its own
+        part_size = transfer_config.multipart_chunksize
+        size = min(
+            len(buffer),
+            len(self._pending),
+            part_size - self.size % part_size,
+        )
+        buffer[:size] = self._pending[:size]
+        self._md5.update(self._pending[:size])
+        self._part_md5.update(self._pending[:size])
+        self._pending = self._pending[size:]
+        self.size += size
+        if self.size % part_size == 0:
+            self._part_digests.append(self._part_md5.digest())
+            self._part_md5 = hashlib.md5()
+        return size
+
+    @property
+    def etag(self) -> str:
+        # the ETag S3 reports for an SSE-S3 object uploaded with
+        # transfer_config, which splits the stream into exact part_size parts
+        if self.size < transfer_config.multipart_threshold:
+            return self._md5.hexdigest()
+        digests = list(self._part_digests)
+        if self.size % transfer_config.multipart_chunksize:
+            digests.append(self._part_md5.digest())
+        digest = hashlib.md5(b"".join(digests)).hexdigest()
+        return f"{digest}-{len(digests)}"
+
 
 def record_handler(record: typing.Dict[str, typing.Any]):
     image_message_event = json.loads(record["body"])
@@ -51,8 +129,12 @@ def record_handler(record: typing.Dict[str, typing.Any]):
     object_key = f"{save_image_prefix}/original/{user_id}/{image_id}"
     message_content = line_bot_api.get_message_content(message_id)
 
+    stream = IterContentStream(
+        message_content.iter_content(chunk_size=CONTENT_CHUNK_SIZE)
+    )
+    # parts are uploaded while the rest of the content is still downloading
     s3.upload_fileobj(
-        Fileobj=BytesIO(message_content.content),
+        Fileobj=io.BufferedReader(stream, buffer_size=CONTENT_CHUNK_SIZE),
         Bucket=bucket_name,
         Key=object_key,
         ExtraArgs={
@@ -63,10 +145,45 @@ def record_handler(record: typing.Dict[str, typing.Any]):
                 "Created": str(unix_time),
             },
         },
+        Config=transfer_config,
+    )
+
+    # consumers get everything they need from the event, without a HEAD
+    res = sns.publish(
+        TopicArn=original_image_created_topic_arn,
+        Message=json.dumps(
+            {
+                "bucket": bucket_name,
+                "key": object_key,
+                "user_id": user_id,
+                "image_id": image_id,
+                "created": unix_time,
+                "content_type": message_content.content_type,
+                "size": stream.size,
+                "etag": stream.etag,
+            }
+        ),
     )
+    logger.debug(res)
 
 
 class SQSProcessor(PartialSQSProcessor):
+    def process(self) -> typing.List[typing.Tuple]:
+        if record_concurrency <= 1:
+            return super().process()
+
+        # worker threads report to sentry with a fork of the invocation's
+        # scopes, so tags set for one record do not leak into another
+        isolation_scope = sentry_sdk.get_isolation_scope()
+        current_scope = sentry_sdk.get_current_scope()
+
+        def process_record(record: typing.Any) -> typing.Tuple:
+            with use_isolation_scope(isolation_scope.fork()):
+                with use_scope(current_scope.fork()):
+                    return self._process_record(record)
+
+        return list(record_executor.map(process_record, self.records))
+
     def failure_handler(
         self, record: typing.Any, exception: typing.Tuple
     ) -> typing.Tuple:
@@ -1,5 +1,7 @@
 import json
 import os
+import sys
+import time
 import typing
 
 from aws_lambda_powertools import (
@@ -30,33 +32,183 @@ if sentry_dsn:
 s3 = boto3.client("s3")
 
 table_name = os.environ["TABLE_NAME"]
+version_table_name = os.environ["VERSION_TABLE_NAME"]
 dynamodb = boto3.client("dynamodb")
 
 
-def record_handler(record: typing.Dict[str, typing.Any]):
+# DynamoDB limit of statements per BatchExecuteStatement
+BATCH_STATEMENT_SIZE = 25
+BATCH_ATTEMPTS = 5
+BATCH_BACKOFF = 0.05
+
+# statement errors that are retried, as BatchWriteItem retries
+# UnprocessedItems
+RETRYABLE_ERRORS = {
+    "InternalServerError",
+    "ProvisionedThroughputExceeded",
+    "RequestLimitExceeded",
+    "ThrottlingError",
+    "TransactionConflict",
+}
+
+ITEM_ATTRIBUTES = ("UserId", "ImageId", "Created", "ContentType", "Size")
+# unlike a PutRequest, an INSERT fails with DuplicateItem instead of
+# replacing a row, so the dimensions and variants the derivative worker
+# stored are never lost
+INSERT_STATEMENT = 'INSERT INTO "{}" VALUE {{{}}}'.format(
+    table_name,
+    ", ".join(f"'{name}': ?" for name in ITEM_ATTRIBUTES),
+)
+
+Item = typing.Dict[str, typing.Dict[str, str]]
+ItemKey = typing.Tuple[str, str]
+
+
+class UnprocessedItemError(Exception):
+    pass
+
+
+def item_key(item: Item) -> ItemKey:
+    return item["UserId"]["S"], item["ImageId"]["S"]
+
+
+def parse_original_created(
+    record: typing.Dict[str, typing.Any],
+) -> typing.Dict[str, typing.Any]:
     notification = json.loads(record["body"])
-    create_object_event = json.loads(notification["Message"])["Records"][0]
-    logger.debug(create_object_event)
+    original_created = json.loads(notification["Message"])
+    logger.debug(original_created)
+    if "Records" not in original_created:
+        return original_created
 
+    # S3 event notifications queued before save_image published the envelope
+    create_object_event = original_created["Records"][0]
     bucket_name = create_object_event["s3"]["bucket"]["name"]
     object_key = create_object_event["s3"]["object"]["key"]
 
     head_response = s3.head_object(Bucket=bucket_name, Key=object_key)
     logger.debug(head_response)
     metadata = head_response["Metadata"]
+    return {
+        "bucket": bucket_name,
+        "key": object_key,
+        "user_id": metadata["userid"],
+        "image_id": metadata["imageid"],
+        "created": float(metadata["created"]),
+        "content_type": head_response["ContentType"],
+        "size": head_response["ContentLength"],
+        "etag": head_response["ETag"].strip('"'),
+    }
 
-    dynamodb.put_item(
-        TableName=table_name,
-        Item={
-            "UserId": {"S": metadata["userid"]},
-            "ImageId": {"S": metadata["imageid"]},
-            "Created": {"N": metadata["created"]},
-            "ContentType": {"S": head_response["ContentType"]},
-        },
+
+def record_handler(record: typing.Dict[str, typing.Any]) -> Item:
+    original_created = parse_original_created(record)
+
+    # written for the whole batch at once by SQSProcessor
+    return {
+        "UserId": {"S": original_created["user_id"]},
+        "ImageId": {"S": original_created["image_id"]},
+        "Created": {"N": str(original_created["created"])},
+        "ContentType": {"S": original_created["content_type"]},
+        "Size": {"N": str(original_created["size"])},
+    }
+
+
+def insert_items(items: typing.List[Item]) -> typing.Dict[ItemKey, str]:
+    # returns the keys that could not be written, with the reason; a row
+    # that already exists counts as written
+    failed = {}
+    for i in range(0, len(items), BATCH_STATEMENT_SIZE):
+        pending = items[i : i + BATCH_STATEMENT_SIZE]
+        for attempt in range(BATCH_ATTEMPTS):
+            if attempt:
+                time.sleep(BATCH_BACKOFF * 2 ** (attempt - 1))
+            try:
+                res = dynamodb.batch_execute_statement(
+                    Statements=[
+                        {
+                            "Statement": INSERT_STATEMENT,
+                            "Parameters": [
+                                item[name] for name in ITEM_ATTRIBUTES
+                            ],
+                        }
+                        for item in pending
+                    ]
+                )
+            except Exception as e:
+                logger.exception("failed to insert items")
+                reason = str(e)
+                continue
+            logger.debug(res)
+            # responses are in the order of the statements
+            retry = []
+            for item, response in zip(pending, res["Responses"]):
+                code = response.get("Error", {}).get("Code")
+                if code in RETRYABLE_ERRORS:
+                    retry.append(item)
+                elif code not in (None, "DuplicateItem"):
+                    failed[item_key(item)] = code
+            pending = retry
+            reason = "unprocessed after retries"
+            if not pending:
+                break
+        for item in pending:
+            failed[item_key(item)] = reason
+    return failed
+
+
+def bump_version(user_id: str) -> None:
+    # bump the user's listing version so GET /images stops answering 304
+    dynamodb.update_item(
+        TableName=version_table_name,
+        Key={"UserId": {"S": user_id}},
+        UpdateExpression="ADD Version :increment",
+        ExpressionAttributeValues={":increment": {"N": "1"}},
     )
 
 
 class SQSProcessor(PartialSQSProcessor):
+    def process(self) -> typing.List[typing.Tuple]:
+        results = {}
+        items: typing.Dict[ItemKey, Item] = {}
+        records: typing.Dict[
+            ItemKey, typing.List[typing.Tuple[int, typing.Any]]
+        ] = {}
+        for i, record in enumerate(self.records):
+            try:
+                item = self.handler(record=record)
+            except Exception:
+                results[i] = self.failure_handler(record, sys.exc_info())
+                continue
+            # redelivered duplicates in one batch are written once
+            items[item_key(item)] = item
+            records.setdefault(item_key(item), []).append((i, record))
+
+        failed = insert_items(list(items.values()))
+        # rows that already existed are bumped too, so a redelivery retries
+        # a bump that failed after the row was written
+        written = [key for key in items if key not in failed]
+        for user_id in sorted({key[0] for key in written}):
+            try:
+                bump_version(user_id)
+            except Exception as e:
+                logger.exception("failed to bump version")
+                for key in written:
+                    if key[0] == user_id:
+                        failed[key] = str(e)
+
+        for key, key_records in records.items():
+            for i, record in key_records:
+                if key not in failed:
+                    results[i] = self.success_handler(record, items[key])
+                    continue
+                try:
+                    raise UnprocessedItemError(f"{key}: {failed[key]}")
+                except UnprocessedItemError:
+                    results[i] = self.failure_handler(record, sys.exc_info())
+
+        return [results[i] for i in range(len(self.records))]
+
     def failure_handler(
         self, record: typing.Any, exception: typing.Tuple
     ) -> typing.Tuple:
@@ -1,20 +1,39 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import (
     datetime,
     timezone,
 )
 import os
+import queue
+import threading
 import typing
 
 from pynamodb.attributes import (
+    MapAttribute,
     UnicodeAttribute,
     NumberAttribute,
 )
+from pynamodb.indexes import (
+    AllProjection,
+    GlobalSecondaryIndex,
+)
 from pynamodb.models import Model
 
+from utils.signed_url import sign_image_path
+
 table_name = os.environ["TABLE_NAME"]
 table_region = os.environ["TABLE_REGION"]
 
 
+class UserCreatedIndex(GlobalSecondaryIndex):
+    class Meta:
+        index_name = "UserIdCreatedIndex"
+        projection = AllProjection()
+
+    user_id = UnicodeAttribute(hash_key=True, attr_name="UserId")
+    created = NumberAttribute(range_key=True, attr_name="Created")
+
+
 class ImageModel(Model):
     class Meta:
         region = table_region
@@ -24,28 +43,208 @@ class ImageModel(Model):
     image_id = UnicodeAttribute(range_key=True, attr_name="ImageId")
     content_type = UnicodeAttribute(attr_name="ContentType")
     created = NumberAttribute(attr_name="Created")
+    # recorded by the derivative worker once the original is decoded
+    width = NumberAttribute(attr_name="Width", null=True)
+    height = NumberAttribute(attr_name="Height", null=True)
+    size = NumberAttribute(attr_name="Size", null=True)
+    placeholder = UnicodeAttribute(attr_name="Placeholder", null=True)
+    # "{format directory}/{size directory}": Width, Height, Size, ContentType
+    variants = MapAttribute(attr_name="Variants", null=True)
+
+    user_created_index = UserCreatedIndex()
+
+
+_SEGMENT_DONE = object()
+
+
+def get_all_items(
+    total_segments: int = 1,
+    max_workers: int = 8,
+    buffer_size: int = 1000,
+    attributes_to_get: typing.Optional[typing.Sequence[str]] = None,
+) -> typing.Iterator[ImageModel]:
+    if total_segments <= 1:
+        yield from ImageModel.scan(attributes_to_get=attributes_to_get)
+        return
+
+    # segments are scanned by a bounded pool and merged through a bounded
+    # queue, so items are yielded as soon as any segment returns a page
+    buffer: queue.Queue = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
 
+    def put(value: typing.Any) -> bool:
+        while not stopped.is_set():
+            try:
+                buffer.put(value, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
 
-def get_all_items():
-    res = ImageModel.scan()
-    items = [item for item in res]
-    while res.last_evaluated_key:
-        res = ImageModel.scan(last_evaluated_key=res.last_evaluated_key)
-        items.extend([item for item in res])
+    def scan_segment(segment: int) -> None:
+        try:
+            for item in ImageModel.scan(
+                segment=segment,
+                total_segments=total_segments,
+                attributes_to_get=attributes_to_get,
+            ):
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+        finally:
+            put(_SEGMENT_DONE)
 
-    return items
+    with ThreadPoolExecutor(
+        max_workers=min(max_workers, total_segments)
+    ) as executor:
+        futures = [
+            executor.submit(scan_segment, segment)
+            for segment in range(total_segments)
+        ]
+
+        remaining = total_segments
+        try:
+            while remaining:
+                value = buffer.get()
+                if value is _SEGMENT_DONE:
+                    remaining -= 1
+                elif isinstance(value, Exception):
+                    raise value
+                else:
+                    yield value
+        finally:
+            stopped.set()
+            for future in futures:
+                future.cancel()
+
+
+def get_user_items(
+    user_id: str,
+    limit: typing.Optional[int] = None,
+    last_evaluated_key: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    attributes_to_get: typing.Optional[typing.Sequence[str]] = None,
+):
+    return ImageModel.query(
+        user_id,
+        limit=limit,
+        page_size=limit,
+        last_evaluated_key=last_evaluated_key,
+        attributes_to_get=attributes_to_get,
+    )
+
+
+def get_user_items_by_created(
+    user_id: str,
+    newest_first: bool = False,
+    since: typing.Optional[float] = None,
+    until: typing.Optional[float] = None,
+    limit: typing.Optional[int] = None,
+    last_evaluated_key: typing.Optional[typing.Dict[str, typing.Any]] = None,
+    attributes_to_get: typing.Optional[typing.Sequence[str]] = None,
+):
+    range_key_condition = None
+    if since is not None and until is not None:
+        range_key_condition = UserCreatedIndex.created.between(since, until)
+    elif since is not None:
+        range_key_condition = UserCreatedIndex.created >= since
+    elif until is not None:
+        range_key_condition = UserCreatedIndex.created <= until
+
+    return ImageModel.user_created_index.query(
+        user_id,
+        range_key_condition=range_key_condition,
+        scan_index_forward=not newest_first,
+        limit=limit,
+        page_size=limit,
+        last_evaluated_key=last_evaluated_key,
+        attributes_to_get=attributes_to_get,
+    )
+
+
+# attributes read by convert_respones_image
+RESPONSE_ATTRIBUTES = [
+    ImageModel.user_id.attr_name,
+    ImageModel.image_id.attr_name,
+    ImageModel.content_type.attr_name,
+    ImageModel.created.attr_name,
+    ImageModel.width.attr_name,
+    ImageModel.height.attr_name,
+    ImageModel.size.attr_name,
+    ImageModel.placeholder.attr_name,
+    ImageModel.variants.attr_name,
+]
+
+# bucket directories: values of the format and size queries of the edge
+VARIANT_FORMATS = {
+    "original_format": "original",
+    "webp": "webp",
+    "avif": "avif",
+}
+ORIGINAL_SIZE = "original_size"
+
+
+def convert_variants(
+    item: ImageModel,
+    url: str,
+) -> typing.List[typing.Dict[str, typing.Any]]:
+    # only what the derivative pipeline recorded, so every url exists; the
+    # format and size queries make the edge serve exactly that object
+    separator = "&" if "?" in url else "?"
+    variants = [
+        {
+            "content_type": item.content_type,
+            "width": item.width,
+            "height": item.height,
+            "size": item.size,
+            "url": f"{url}{separator}format=original&size=original",
+        }
+    ]
+    recorded = item.variants.as_dict() if item.variants else {}
+    for key, variant in recorded.items():
+        directory, _, size = key.partition("/")
+        if directory not in VARIANT_FORMATS:
+            continue
+        query_size = "original" if size == ORIGINAL_SIZE else size
+        variants.append(
+            {
+                "content_type": variant["ContentType"],
+                "width": variant["Width"],
+                "height": variant["Height"],
+                "size": variant["Size"],
+                "url": f"{url}{separator}format={VARIANT_FORMATS[directory]}"
+                f"&size={query_size}",
+            }
+        )
+    variants.sort(key=lambda v: (v["width"] or 0, v["size"] or 0))
+    return variants
 
 
 def convert_respones_image(
     item: ImageModel,
     base_url: str,
     image_prefix: str,
+    url_secret: typing.Optional[bytes] = None,
+    url_expires: typing.Optional[int] = None,
 ) -> typing.Dict[str, typing.Any]:
+    path = "/".join([image_prefix, item.user_id, item.image_id])
+    url = base_url + path
+    if url_secret and url_expires:
+        signature = sign_image_path(
+            url_secret, item.user_id, "/" + path, url_expires
+        )
+        url += f"?expires={url_expires}&signature={signature}"
+
     return {
         "id": item.image_id,
-        "url": base_url + "/".join([image_prefix, item.user_id, item.image_id]),
+        "url": url,
         "timestamp": datetime.fromtimestamp(
             item.created, timezone.utc
         ).isoformat(),
         "user_id": item.user_id,
+        "width": item.width,
+        "height": item.height,
+        "size": item.size,
+        "placeholder": item.placeholder,
+        "variants": convert_variants(item, url),
     }
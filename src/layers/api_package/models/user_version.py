@@ -0,0 +1,26 @@
+import os
+
+from pynamodb.attributes import (
+    UnicodeAttribute,
+    NumberAttribute,
+)
+from pynamodb.models import Model
+
+table_name = os.environ["VERSION_TABLE_NAME"]
+table_region = os.environ["TABLE_REGION"]
+
+
+class UserVersionModel(Model):
+    class Meta:
+        region = table_region
+        table_name = table_name
+
+    user_id = UnicodeAttribute(hash_key=True, attr_name="UserId")
+    version = NumberAttribute(attr_name="Version", default=0)
+
+
+def get_version(user_id: str) -> int:
+    try:
+        return int(UserVersionModel.get(user_id).version)
+    except UserVersionModel.DoesNotExist:
+        return 0
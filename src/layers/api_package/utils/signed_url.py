@@ -0,0 +1,17 @@
+import base64
+import hashlib
+import hmac
+
+
+def sign_image_path(
+    secret: bytes,
+    user_id: str,
+    path: str,
+    expires: int,
+) -> str:
+    digest = hmac.new(
+        secret,
+        f"{user_id}\n{path}\n{expires}".encode(),
+        hashlib.sha256,
+    ).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip("=")
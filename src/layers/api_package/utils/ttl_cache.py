@@ -0,0 +1,89 @@
+from collections import OrderedDict
+import threading
+import time
+import typing
+
+
+# size-bounded LRU cache whose entries also expire after a TTL, meant to
+# live in the Lambda module scope and be shared by warm invocations
+class TTLCache:
+    def __init__(self, max_size: int, ttl: float) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        self._items: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(
+        self,
+        key: typing.Hashable,
+        default: typing.Any = None,
+    ) -> typing.Any:
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self._items[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(
+        self,
+        key: typing.Hashable,
+        value: typing.Any,
+        ttl: typing.Optional[float] = None,
+    ) -> None:
+        if ttl is None:
+            ttl = self.ttl
+        if self.max_size <= 0 or ttl <= 0:
+            return
+
+        with self._lock:
+            self._items[key] = (time.monotonic() + ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(
+        self,
+        predicate: typing.Callable[[typing.Hashable], bool],
+    ) -> int:
+        with self._lock:
+            keys = [key for key in self._items if predicate(key)]
+            for key in keys:
+                del self._items[key]
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> typing.Dict[str, typing.Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,111 @@
+import os
+import typing
+
+from aws_lambda_powertools import Logger
+import boto3
+from linebot import (
+    LineBotApi,
+    WebhookHandler,
+)
+from linebot.exceptions import (
+    LineBotApiError,
+)
+from linebot.models import (
+    ImageMessage,
+    MessageEvent,
+    TextMessage,
+    TextSendMessage,
+)
+
+# webhook bodies are dispatched here both by line_webhook_post_callback and,
+# in fast ack mode, by line_webhook_dispatch_events
+logger = Logger(child=True)
+
+line_bot_api = LineBotApi(os.environ["CHANNEL_ACCESS_TOKEN"])
+handler = WebhookHandler(os.environ["CHANNEL_SECRET"])
+
+save_image_queue_url = os.environ["SAVE_IMAGE_QUEUE_URL"]
+sqs = boto3.client("sqs")
+
+# SQS limit of entries per SendMessageBatch
+SEND_MESSAGE_BATCH_SIZE = 10
+
+# image events of the delivery being handled, enqueued after dispatch
+image_events: typing.List[MessageEvent] = []
+
+
+class EnqueueError(Exception):
+    pass
+
+
+def image_set_key(event: MessageEvent) -> typing.Tuple[str, int]:
+    image_set = getattr(event.message, "image_set", None)
+    if image_set is None:
+        return "", 0
+    return image_set.id, image_set.index or 0
+
+
+def send_message_batch(entries: typing.List[typing.Dict[str, str]]) -> None:
+    res = sqs.send_message_batch(
+        QueueUrl=save_image_queue_url,
+        Entries=entries,
+    )
+    logger.debug(res)
+    failed = [f for f in res.get("Failed", []) if not f.get("SenderFault")]
+    if failed:
+        # retry only the failed entries, once
+        failed_ids = {f["Id"] for f in failed}
+        res = sqs.send_message_batch(
+            QueueUrl=save_image_queue_url,
+            Entries=[e for e in entries if e["Id"] in failed_ids],
+        )
+        logger.debug(res)
+    if res.get("Failed"):
+        raise EnqueueError(res["Failed"])
+
+
+def enqueue_image_events(events: typing.List[MessageEvent]) -> None:
+    # images of the same set go out together and in order
+    events = sorted(events, key=image_set_key)
+    for i in range(0, len(events), SEND_MESSAGE_BATCH_SIZE):
+        send_message_batch(
+            [
+                {"Id": str(j), "MessageBody": event.as_json_string()}
+                for j, event in enumerate(
+                    events[i : i + SEND_MESSAGE_BATCH_SIZE]
+                )
+            ]
+        )
+
+
+def dispatch(body: str, signature: str) -> None:
+    # raises InvalidSignatureError for a body LINE did not sign
+    image_events.clear()
+    try:
+        handler.handle(body, signature)
+    finally:
+        # images dispatched before a failing handler are still saved
+        enqueue_image_events(image_events)
+
+
+@handler.add(MessageEvent, message=TextMessage)
+def handle_text_message(event: MessageEvent) -> None:
+    # best effort: a reply token is spent after one use, so a failed reply
+    # must not fail the delivery and get it retried
+    try:
+        line_bot_api.reply_message(
+            event.reply_token,
+            TextSendMessage(text=event.message.text),
+        )
+    except LineBotApiError:
+        logger.exception("failed to reply message")
+
+
+@handler.add(MessageEvent, message=ImageMessage)
+def handle_image_message(event: MessageEvent) -> None:
+    image_events.append(event)
+
+
+@handler.default()
+def handle_default(event) -> None:
+    logger.debug(event.as_json_dict())